@@ -3,16 +3,69 @@ import os
 import base64
 import uuid
 
-from tornado import ioloop
+from tornado import ioloop, netutil
+from tornado.httpserver import HTTPServer
 from tornado.web import Application, StaticFileHandler
 from tornado.options import define, options
-from tornadio2.router import TornadioRouter
 
+import notifications  # registers its crud hook
+import prefork
+import search
+import sync
 from handlers import *
-from sock import Connection
+from models import (Activity, Notification, connect_db, delete_orphans,
+                    hot_boards, pending_writes, reconnect_db)
+from presence import presence
+from sock import Connection, Router
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    ThreadPoolExecutor = None
 
 define("port", default=8000)
+define("address", default='')
 define("debug", default=True, type=bool)
+define("workers", default=1, type=int,
+       help="worker processes, 0 means one per cpu, >1 enables pre-fork mode")
+define("worker_port", default=0, type=int,
+       help="first private port of pre-fork workers, default port + 1")
+define("drain_timeout", default=10, type=int,
+       help="seconds to wait for open connections on shutdown")
+define("mongo_host", default='localhost',
+       help="mongodb host or mongodb:// uri")
+define("mongo_db", default='cantas')
+define("mongo_pool_size", default=100, type=int)
+define("mongo_connect_timeout_ms", default=5000, type=int)
+define("mongo_server_selection_timeout_ms", default=10000, type=int)
+define("mongo_compressors", default='',
+       help="comma separated wire compressors, e.g. zstd,snappy,zlib")
+define("mongo_secondary_preference", default='secondary_preferred',
+       help="read preference of reads that may go to secondaries")
+define("sync_concurrency", default=4, type=int,
+       help="sources fetched at the same time by the sync scheduler, "
+            "0 disables syncing")
+define("activity_keep", default=1000, type=int,
+       help="activities kept per board by the compaction job, 0 keeps "
+            "all of them")
+define("activity_max_age_days", default=0, type=int,
+       help="drop activities older than this, 0 means keep forever")
+define("activity_compact_interval", default=3600, type=int,
+       help="seconds between activity compaction runs")
+define("write_coalesce_window", default=0.3, type=float,
+       help="seconds updates of a document are merged before they are "
+            "written, 0 writes every update")
+define("board_cache_mb", default=0, type=int,
+       help="memory for lists and cards of recently joined boards, reads of "
+            "them skip the database, 0 disables it")
+define("board_cache_max_age", default=60, type=int,
+       help="seconds a cached board is served before it is reloaded")
+define("search_refresh_interval", default=30, type=int,
+       help="seconds between indexing cards and comments written by other "
+            "processes, sync and imports for search, 0 disables it")
+define("orphan_sweep_interval", default=86400, type=int,
+       help="seconds between deletions of documents whose card, list or "
+            "board is gone, 0 disables them")
 options.parse_command_line()
 
 settings = {
@@ -30,7 +83,19 @@ try:
 except ImportError:
     pass
 
-SockServer = TornadioRouter(Connection)
+mongo_settings = {
+    'host': options.mongo_host,
+    'db': options.mongo_db,
+    'maxPoolSize': options.mongo_pool_size,
+    'connectTimeoutMS': options.mongo_connect_timeout_ms,
+    'serverSelectionTimeoutMS': options.mongo_server_selection_timeout_ms,
+    'secondary_preference': options.mongo_secondary_preference,
+}
+if options.mongo_compressors:
+    mongo_settings['compressors'] = options.mongo_compressors
+# secret settings may hold credentials or any other MongoClient argument
+mongo_settings.update(settings.pop('mongo', {}))
+connect_db(**mongo_settings)
 
 static_urls = [
     (r'/%s/(.*)' % i, StaticFileHandler, {'path': './static/%s' % i})
@@ -49,20 +114,96 @@ urls = [
     (r'/api/invited', InvitedBoardsHandler),
     (r'/api/new', NewBoardHandler),
     (r'/api/cards/mine', MyCardsHandler),
+    (r'/api/notifications/unread', UnreadNotificationsHandler),
     (r'/api/archived/cards/(\w+)', ArchivedCardsHandler),
     (r'/api/archived/lists/(\w+)', ArchivedListsHandler),
     (r'/api/archived/getorders/(\w+)', OrderCardHandler),
+    (r'/api/search/(\w+)', SearchHandler),
+    (r'/api/export/(\w+)\.(json|csv)', BoardExportHandler),
     (r'/board/(\w+)/(\w+)', SingleBoardHandler),
     (r'/card/(\w+)/(\w+)', SingleCardHandler),
     (r'/upload/(\w+)', AttachmentHandler),
+    (r'/api/import/trello', TrelloImportHandler),
+    (r'/api/import/trello/(\w+)', TrelloImportHandler),
     (r'/attachment/(\w+)/download', AttachmentHandler),
     (r'/welcome', WelcomeHandler),
     (r'/standalonehelp', StandaloneHandler),
     (r'/help', MainHandler),
     (r'/account', MainHandler),
-] + static_urls + SockServer.urls
+] + static_urls
 
-if __name__ == '__main__':
-    app = Application(urls, **settings)
-    app.listen(port=options.port)
+
+# runs periodic maintenance jobs, which are too slow for the IOLoop
+maintenance = ThreadPoolExecutor(1) if ThreadPoolExecutor else None
+
+
+def in_background(func, *args):
+    """ callback running `func(*args)` on the maintenance thread """
+    def callback():
+        if maintenance is None:
+            func(*args)
+            return
+        # result() raises errors of `func` on the IOLoop, which logs them
+        ioloop.IOLoop.current().add_future(maintenance.submit(func, *args),
+                                           lambda future: future.result())
+    return callback
+
+
+def start_worker(sockets, worker_id=None):
+    """ serve on `sockets` until drained, `worker_id` is None when not
+    running in pre-fork mode
+    """
+    app_settings = dict(settings)
+    if worker_id is not None:
+        # never share a connection inherited from the master
+        reconnect_db()
+        # restarting forked process is up to the master
+        app_settings['autoreload'] = False
+
+    search.index.rebuild()
+    if options.search_refresh_interval:
+        ioloop.PeriodicCallback(
+            search.index.refresh,
+            options.search_refresh_interval * 1000).start()
+    presence.start()
+
+    # tornadio2 router binds to the IOLoop, so it is created after fork
+    sock_server = Router(Connection, worker_id=worker_id)
+    # client address comes from the router's X-Forwarded-For in pre-fork mode
+    server = HTTPServer(Application(urls + sock_server.urls, **app_settings),
+                        xheaders=worker_id is not None)
+    server.add_sockets(sockets)
+
+    if not worker_id:
+        # counters of notifications created before they were kept
+        ioloop.IOLoop.current().add_callback(
+            in_background(Notification.backfill_unread))
+        ioloop.PeriodicCallback(
+            in_background(Activity.compact, options.activity_keep,
+                          options.activity_max_age_days),
+            options.activity_compact_interval * 1000
+        ).start()
+        if options.orphan_sweep_interval:
+            ioloop.PeriodicCallback(
+                in_background(delete_orphans),
+                options.orphan_sweep_interval * 1000).start()
+        if options.sync_concurrency:
+            sync.SyncScheduler(options.sync_concurrency).start()
+
+    pending_writes.window = options.write_coalesce_window
+    hot_boards.budget = options.board_cache_mb * 2 ** 20
+    hot_boards.max_age = options.board_cache_max_age
+    prefork.drain_on_signal(server, lambda: not Connection.online,
+                            options.drain_timeout, [pending_writes.flush])
     ioloop.IOLoop.instance().start()
+    # updates of connections still open when draining timed out
+    pending_writes.flush()
+
+
+if __name__ == '__main__':
+    if options.workers == 1:
+        start_worker(netutil.bind_sockets(options.port, options.address))
+    else:
+        prefork.run(start_worker, options.port, options.address,
+                    options.workers, options.worker_port,
+                    options.drain_timeout)
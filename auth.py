@@ -1,21 +1,95 @@
 # -*- coding: utf-8 -*-
-import re
-import functools
+import json
+import logging
+import time
+from collections import OrderedDict
 
 from tornado import httpclient
 from tornado import escape
+from tornado import gen
 from tornado.httputil import url_concat
-from tornado.auth import OAuth2Mixin, _auth_return_future, AuthError
+from tornado.auth import OAuth2Mixin, AuthError
+from tornado.options import define, options
 
 try:
-    import urllib.parse as urllib_parse
+    from urllib.parse import parse_qs, urlencode
 except ImportError:
-    import urllib as urllib_parse
+    from urllib import urlencode
+    from urlparse import parse_qs
+
+define("oauth_max_clients", default=20, type=int,
+       help="concurrent requests to the oauth provider, others are queued")
+define("oauth_connect_timeout", default=5, type=float,
+       help="seconds to connect to the oauth provider")
+define("oauth_request_timeout", default=10, type=float,
+       help="seconds for a request to the oauth provider, queueing included")
+
+logger = logging.getLogger('cantas.auth')
+
+_http_client = None
+
+
+def auth_http_client():
+    """ keep-alive client shared by all logins of this process, curl keeps
+    connections to the provider open where pycurl is installed
+    """
+    global _http_client
+
+    if _http_client is None:
+        try:
+            from tornado.curl_httpclient import CurlAsyncHTTPClient as cls
+        except ImportError:
+            cls = httpclient.AsyncHTTPClient
+        _http_client = cls(force_instance=True,
+                           max_clients=options.oauth_max_clients)
+    return _http_client
+
+
+class ExpiringCache(object):
+    """ LRU of at most `max_size` values each expiring after its ttl """
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self._data = OrderedDict()
+
+    def get(self, key):
+        expires, value = self._data.pop(key, (0, None))
+        if expires < time.time():
+            return None
+        self._data[key] = (expires, value)
+        return value
+
+    def set(self, key, value, ttl):
+        self._data.pop(key, None)
+        self._data[key] = (time.time() + ttl, value)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def pop(self, key):
+        return self._data.pop(key, (0, None))[1]
+
+
+# access token -> openid, until the token expires
+openids = ExpiringCache()
+# openid -> user info
+user_infos = ExpiringCache()
+user_info_ttl = 600
+
+
+def _parse_jsonp(body):
+    """ QQ wraps json in `callback( ... );` """
+    body = escape.native_str(body)
+    return json.loads(body[body.index('{'):body.rindex('}') + 1])
 
 
 class QQOAuth2Mixin(OAuth2Mixin):
     """Handles the login for the QQ user, returning a user object.
 
+    The provider is `settings['qq_oauth']['url']` if set, e.g. a local mock
+    server in tests, graph.qq.com otherwise. Openids and user infos are
+    cached, so a user logging in again with a still valid token skips those
+    calls.
+
         Example usage::
 
         class QQLoginHandler(tornado.web.RequestHandler,
@@ -35,109 +109,101 @@ class QQOAuth2Mixin(OAuth2Mixin):
                         client_id=self.settings['qq_oauth']['key'],
                         redirect_uri=redirect_uri)
     """
-    _OAUTH_ACCESS_TOKEN_URL = 'https://graph.qq.com/oauth2.0/token?'
-    _OAUTH_AUTHORIZE_URL = 'https://graph.qq.com/oauth2.0/authorize?'
 
-    @_auth_return_future
+    @property
+    def _qq_url(self):
+        return self.settings.get('qq_oauth', {}).get(
+            'url', 'https://graph.qq.com')
+
+    @property
+    def _OAUTH_ACCESS_TOKEN_URL(self):
+        return self._qq_url + '/oauth2.0/token?'
+
+    @property
+    def _OAUTH_AUTHORIZE_URL(self):
+        return self._qq_url + '/oauth2.0/authorize?'
+
+    @gen.coroutine
     def get_authenticated_user(self, redirect_uri, client_id, client_secret,
-                               code, callback, grant_type='authorization_code',
+                               code, grant_type='authorization_code',
                                extra_fields=None):
-        http = self.get_auth_http_client()
-        args = {
-            'redirect_uri': redirect_uri,
-            'code': code,
-            'client_id': client_id,
-            'client_secret': client_secret,
-            'extra_params': {'grant_type': grant_type}
-        }
-
+        timings = []
         fields = {'nickname', 'figureurl'}
-
         if extra_fields:
             fields.update(extra_fields)
 
-        http.fetch(self._oauth_request_token_url(**args),
-                   functools.partial(self._on_access_token, client_id,
-                                     callback, fields))
-
-    def _on_access_token(self, client_id, future, fields, response):
-        if response.error:
-            future.set_exception(AuthError('QQ auth error %s' % str(response)))
-            return
-
-        args = escape.native_str(response.body).split('&')
-        session = {
-            'access_token': args[0].split('=')[1],
-            'expires': args[1].split('=')[1],
-        }
-
-        http = self.get_auth_http_client()
-        http.fetch(url_concat('https://graph.qq.com/oauth2.0/me?',
-                              {'access_token': session['access_token']}),
-                   functools.partial(self._on_access_openid, client_id,
-                                     session, future, fields))
-
-    def _on_access_openid(self, client_id, session, future, fields, response):
-        if response.error:
-            future.set_exception(
-                AuthError('Error response %s fetching %s',
-                          response.error, response.request.url)
-            )
-            return
-
-        res = re.search(r'"openid":"([a-zA-Z0-9]+)"',
-                        escape.native_str(response.body))
-
-        session['openid'] = res.group(1)
-
-        self.qq_request(
-            path='/user/get_user_info',
-            callback=functools.partial(
-                self._on_get_user_info, future, session, fields),
-            access_token=session['access_token'],
-            openid=session['openid'],
-            oauth_consumer_key=client_id,
-        )
-
-    def _on_get_user_info(self, future, session, fields, user):
+        body = yield self._qq_fetch(
+            'token', timings, self._oauth_request_token_url(
+                redirect_uri=redirect_uri, code=code, client_id=client_id,
+                client_secret=client_secret,
+                extra_params={'grant_type': grant_type}))
+        token = parse_qs(escape.native_str(body))
+        if 'access_token' not in token:
+            raise AuthError('QQ auth error %s' % escape.native_str(body))
+        session = {'access_token': token['access_token'][0],
+                   'expires': token.get('expires_in', ['0'])[0]}
+
+        session['openid'] = openids.get(session['access_token'])
+        if session['openid'] is None:
+            body = yield self._qq_fetch('openid', timings, url_concat(
+                self._qq_url + '/oauth2.0/me',
+                {'access_token': session['access_token']}))
+            session['openid'] = _parse_jsonp(body).get('openid')
+            if not session['openid']:
+                raise AuthError('QQ openid error %s' %
+                                escape.native_str(body))
+            openids.set(session['access_token'], session['openid'],
+                        int(session['expires'] or 0))
+
+        user = user_infos.get(session['openid'])
         if user is None:
-            future.set_result(None)
-            return
+            user = yield self.qq_request(
+                '/user/get_user_info', timings=timings,
+                access_token=session['access_token'],
+                openid=session['openid'], oauth_consumer_key=client_id)
+            if user.get('ret'):
+                raise AuthError('QQ user info error %s' % user.get('msg'))
+            user_infos.set(session['openid'], user, user_info_ttl)
+
+        logger.info('qq login %s: %s', session['openid'], ', '.join(
+            '%s %.1fms' % (step, elapsed * 1000)
+            for step, elapsed in timings) or 'cached')
 
         fieldmap = {field: user.get(field) for field in fields}
-
         fieldmap.update({'access_token': session['access_token'],
-                         'session_expires': session.get('expires'),
+                         'session_expires': session['expires'],
                          'openid': session['openid']})
+        raise gen.Return(fieldmap)
 
-        future.set_result(fieldmap)
-
-    @_auth_return_future
-    def qq_request(self, path, callback, response_format='json',
-                   post_data=None, **args):
-        url = 'https://graph.qq.com' + path
+    @gen.coroutine
+    def qq_request(self, path, response_format='json', post_data=None,
+                   timings=None, **args):
         all_args = {'format': response_format}
         all_args.update(args)
+        url = url_concat(self._qq_url + path, all_args)
 
-        url += '?' + urllib_parse.urlencode(all_args)
-
-        callback = functools.partial(self._on_qq_request, callback)
-        http = self.get_auth_http_client()
         if post_data is not None:
-            http.fetch(url, callback=callback, method="POST",
-                       body=urllib_parse.urlencode(post_data))
+            body = yield self._qq_fetch(
+                path, timings, url, method='POST',
+                body=urlencode(post_data))
         else:
-            http.fetch(url, callback=callback)
-
-    def _on_qq_request(self, future, response):
-        if response.error:
-            future.set_exception(
-                AuthError('Error response %s fetching %s',
-                          response.error, response.request.url)
-            )
-            return
-
-        future.set_result(escape.json_decode(response.body))
+            body = yield self._qq_fetch(path, timings, url)
+        raise gen.Return(escape.json_decode(body))
+
+    @gen.coroutine
+    def _qq_fetch(self, step, timings, url, **kwargs):
+        """ fetch `url` and append (`step`, seconds taken) to `timings` """
+        started = time.time()
+        try:
+            response = yield self.get_auth_http_client().fetch(
+                url, connect_timeout=options.oauth_connect_timeout,
+                request_timeout=options.oauth_request_timeout, **kwargs)
+        except httpclient.HTTPError as e:
+            raise AuthError('Error response %s fetching %s' % (e, step))
+        finally:
+            if timings is not None:
+                timings.append((step, time.time() - started))
+        raise gen.Return(response.body)
 
     def get_auth_http_client(self):
-        return httpclient.AsyncHTTPClient()
+        return auth_http_client()
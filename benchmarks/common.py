@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers shared by the benchmark scripts: latency summaries, results files
+and comparison with a stored baseline.
+"""
+from __future__ import print_function
+
+import json
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+
+def percentile(sorted_values, pct):
+    """ nearest-rank percentile of an already sorted list """
+    if not sorted_values:
+        return 0.0
+    index = int(round(pct / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+def summarize(samples, elapsed=None):
+    """ summarize a list of durations in seconds, result is in milliseconds
+
+    `elapsed` is the wall time the samples were collected in, used to
+    compute throughput
+    """
+    values = sorted(samples)
+    summary = {
+        'count': len(values),
+        'mean': sum(values) / len(values) * 1000 if values else 0.0,
+        'p50': percentile(values, 50) * 1000,
+        'p95': percentile(values, 95) * 1000,
+        'p99': percentile(values, 99) * 1000,
+        'max': values[-1] * 1000 if values else 0.0,
+    }
+    if elapsed:
+        summary['throughput'] = len(values) / elapsed
+    return summary
+
+
+def rss():
+    """ resident set size of the process in bytes """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except IOError:
+        # the peak rather than the current size, which is all there is
+        # outside linux, in bytes on macos and in kilobytes elsewhere
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD']).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def write_results(path, suite, results, **extra):
+    """ write results as json so runs of different commits can be compared """
+    data = {
+        'suite': suite,
+        'revision': git_revision(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'results': results,
+    }
+    data.update(extra)
+    with open(path, 'w') as output_file:
+        json.dump(data, output_file, indent=2, sort_keys=True)
+
+
+def compare(results, baseline_path, metric, threshold):
+    """ compare `metric` of every result with the baseline file
+
+    return names whose metric got worse by more than `threshold` (0.1 means
+    10%), results missing from baseline are ignored
+    """
+    with open(baseline_path) as baseline_file:
+        baseline = json.load(baseline_file)['results']
+
+    regressions = []
+    for name, result in sorted(results.items()):
+        if name not in baseline or not baseline[name].get(metric):
+            continue
+        old, new = baseline[name][metric], result[metric]
+        change = (new - old) / float(old)
+        print('%-40s %12.3f -> %12.3f  %+7.1f%%' % (name, old, new,
+                                                      change * 100))
+        if change > threshold:
+            regressions.append(name)
+    return regressions
+
+
+def print_table(results, columns):
+    print('%-40s' % 'name' + ''.join('%12s' % c for c in columns))
+    for name, result in sorted(results.items()):
+        print('%-40s' % name +
+              ''.join('%12.3f' % result.get(c, 0) for c in columns))
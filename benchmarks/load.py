@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+"""
+End-to-end load generator.
+
+Starts `app.py` (unless `--url` points at a running server), logs in with
+the dev admin account and runs `--clients` simulated socket.io clients.
+Every client joins a board, reads its lists and cards, creates and patches
+cards, votes, comments and polls the `/api/*` endpoints, so latencies are
+reported per crud event and per endpoint.
+
+The app needs a mongod it can reach, use a throw-away database.
+
+    Example usage::
+
+        python benchmarks/load.py --clients=2000 --output=load.json
+        python benchmarks/load.py --clients=2000 --baseline=load.json
+"""
+from __future__ import print_function
+
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+from collections import defaultdict
+
+from tornado import gen, ioloop
+from tornado.concurrent import Future
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest, HTTPError
+from tornado.options import define, options
+from tornado.websocket import websocket_connect
+
+from common import compare, print_table, summarize, write_results
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+define('url', default='', help='url of a running server, default starts one')
+define('port', default=8899, help='port of the started server')
+define('app_args', default='', help='extra arguments for started app.py')
+define('clients', default=200)
+define('boards', default=10, help='boards the clients are spread over')
+define('iterations', default=5, help='scenario iterations per client')
+define('ramp', default=10.0, help='seconds to start all clients in')
+define('timeout', default=30.0, help='seconds to wait for one operation')
+define('output', default='', help='write json results to this file')
+define('baseline', default='', help='compare p95 with this results file')
+define('threshold', default=0.2, help='allowed p95 regression')
+
+# operation name -> latencies in seconds
+samples = defaultdict(list)
+errors = defaultdict(int)
+
+
+class SocketClient(object):
+    """ minimal socket.io 0.9 websocket client speaking tornadio2 protocol """
+
+    def __init__(self, base_url, cookie):
+        self.base_url = base_url
+        self.cookie = cookie
+        self.ws = None
+        self.message_id = 0
+        self.pending = {}
+        self.events = defaultdict(list)
+
+    @gen.coroutine
+    def connect(self):
+        response = yield AsyncHTTPClient().fetch(
+            '%s/socket.io/1/?t=%d' % (self.base_url, time.time() * 1000),
+            headers={'Cookie': self.cookie})
+        session_id = response.body.decode().split(':')[0]
+        self.ws = yield websocket_connect(HTTPRequest(
+            '%s/socket.io/1/websocket/%s' % (
+                self.base_url.replace('http', 'ws', 1), session_id),
+            headers={'Cookie': self.cookie}))
+        self._read_loop()
+
+    @gen.coroutine
+    def _read_loop(self):
+        while True:
+            packet = yield self.ws.read_message()
+            if packet is None:
+                break
+            kind, message_id, endpoint, data = (packet.split(':', 3) +
+                                                [''])[:4]
+            if kind == '2':
+                self.ws.write_message(u'2::')
+            elif kind == '5':
+                event = json.loads(data)
+                self.events[event['name']].append(event.get('args'))
+            elif kind == '6':
+                ack_id, _, payload = data.partition('+')
+                future = self.pending.pop(int(ack_id), None)
+                if future is not None:
+                    future.set_result(payload and json.loads(payload))
+
+        for future in self.pending.values():
+            future.set_exception(IOError('connection closed'))
+
+    def emit(self, name, *args):
+        """ send event and return a future resolved with its ack """
+        self.message_id += 1
+        future = self.pending[self.message_id] = Future()
+        self.ws.write_message(u'5:%d+::%s' % (self.message_id, json.dumps(
+            {'name': name, 'args': list(args)})))
+        return future
+
+    def close(self):
+        if self.ws is not None:
+            self.ws.close()
+
+
+@gen.coroutine
+def timed(name, future_factory):
+    start = time.time()
+    try:
+        result = yield gen.with_timeout(time.time() + options.timeout,
+                                        future_factory())
+    except Exception:
+        errors[name] += 1
+        raise gen.Return(None)
+    samples[name].append(time.time() - start)
+    raise gen.Return(result)
+
+
+@gen.coroutine
+def http_get(base_url, cookie, path, name=None):
+    response = yield timed(
+        'GET %s' % (name or path),
+        lambda: AsyncHTTPClient().fetch(base_url + path,
+                                        headers={'Cookie': cookie}))
+    if response is not None:
+        raise gen.Return(json.loads(response.body.decode()))
+
+
+@gen.coroutine
+def run_client(base_url, cookie, user_id, board):
+    client = SocketClient(base_url, cookie)
+    yield timed('connect', client.connect)
+    if client.ws is None:
+        return
+
+    emit = lambda name, **kwargs: timed(name,
+                                        lambda: client.emit(name, kwargs))
+    for _ in range(options.iterations):
+        yield emit('join-board', boardId=board['boardId'])
+        lists = yield emit('list:read', boardId=board['boardId'])
+        yield emit('card:read', boardId=board['boardId'])
+        yield emit('activity:read', boardId=board['boardId'])
+        if not lists or not lists[1]:
+            continue
+
+        yield emit('card:create', title='load test card',
+                   listId=random.choice(lists[1])['_id'],
+                   boardId=board['boardId'])
+        if not client.events['/card:create']:
+            continue
+        card = client.events['/card:create'].pop()[0]
+        yield emit('card:patch', id=card['_id'], title='patched card')
+        yield emit('vote:create', cardId=card['_id'], authorId=user_id,
+                   yesOrNo=random.random() > 0.5)
+        yield emit('comment:create', cardId=card['_id'], authorId=user_id,
+                   content='load test comment')
+
+        yield http_get(base_url, cookie, '/api/mine')
+        yield http_get(base_url, cookie, '/api/cards/mine')
+        yield http_get(base_url, cookie,
+                       '/api/archived/cards/%s' % board['boardId'],
+                       '/api/archived/cards/<boardId>')
+    client.close()
+
+
+@gen.coroutine
+def login(base_url):
+    try:
+        yield AsyncHTTPClient().fetch(base_url + '/login', method='POST',
+                                      body='username=admin&password=admin',
+                                      follow_redirects=False)
+    except HTTPError as e:
+        cookie = e.response.headers['Set-Cookie'].split(';')[0]
+        raise gen.Return((cookie, cookie.split('=', 1)[1]))
+    raise RuntimeError('login did not set a cookie')
+
+
+@gen.coroutine
+def run(base_url):
+    cookie, user_id = yield login(base_url)
+    boards = []
+    while len(boards) < options.boards:
+        # the first request of a new user is redirected to /welcome
+        board = yield http_get(base_url, cookie, '/api/new')
+        if board:
+            boards.append(board)
+
+    delay = options.ramp / max(options.clients, 1)
+    clients = []
+    start = time.time()
+    for i in range(options.clients):
+        clients.append(run_client(base_url, cookie, user_id,
+                                  boards[i % len(boards)]))
+        yield gen.Task(ioloop.IOLoop.current().add_timeout,
+                       time.time() + delay)
+    yield clients
+    raise gen.Return(time.time() - start)
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return
+        except socket.error:
+            time.sleep(0.2)
+    raise RuntimeError('server did not start on port %d' % port)
+
+
+def main():
+    options.parse_command_line()
+    AsyncHTTPClient.configure(None, max_clients=options.clients)
+
+    server = None
+    base_url = options.url.rstrip('/')
+    if not base_url:
+        server = subprocess.Popen(
+            [sys.executable, 'app.py', '--port=%d' % options.port,
+             '--debug=false', '--logging=warning'] + options.app_args.split(),
+            cwd=ROOT)
+        wait_for_port(options.port)
+        base_url = 'http://127.0.0.1:%d' % options.port
+
+    try:
+        elapsed = ioloop.IOLoop.current().run_sync(lambda: run(base_url))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    results = dict((name, summarize(values, elapsed))
+                   for name, values in samples.items())
+    for name, count in errors.items():
+        results.setdefault(name, summarize([], elapsed))['errors'] = count
+
+    print_table(results, ('count', 'throughput', 'p50', 'p95', 'p99'))
+    if options.output:
+        write_results(options.output, 'load', results,
+                      clients=options.clients, iterations=options.iterations)
+    if options.baseline:
+        regressions = compare(results, options.baseline, 'p95',
+                              options.threshold)
+        if regressions:
+            print('p95 regressed: %s' % ', '.join(regressions))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
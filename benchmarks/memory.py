@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""
+Memory held per idle socket.io connection.
+
+Simulates `--sizes` idle sessions, each a `sock.Connection` on a stub
+tornadio2 session, registered online and present on one of `--boards`
+boards, and reports the bytes per connection of everything reachable from
+the connections and the registries holding them, measured by walking them
+with `sys.getsizeof`, which works on the python 2 the app runs on. Objects
+shared by connections are counted once. Mode 'record' keeps a
+`SessionUser` per connection like `Connection.on_open`, mode 'document'
+keeps a whole `User` document as it used to, for comparison. No database
+is needed.
+
+    Example usage::
+
+        python benchmarks/memory.py --sizes=10000,50000,100000
+        python benchmarks/memory.py --output=memory.json
+        python benchmarks/memory.py --baseline=memory.json --threshold=0.1
+"""
+from __future__ import print_function
+
+import os
+import sys
+import types
+
+from bson import ObjectId
+from tornado.options import define, options
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from models import User, get_permissions
+from presence import presence
+from sock import Connection, SessionUser
+from common import compare, print_table, write_results
+
+define('sizes', default='10000,50000,100000', help='simulated connections')
+define('modes', default='record,document', help='per connection user state')
+define('boards', default=100, help='boards the connections are spread over')
+define('users', default=0, help='distinct users, default one per connection')
+define('output', default='', help='write json results to this file')
+define('baseline', default='', help='compare with this results file')
+define('threshold', default=0.1, help='allowed bytes per connection growth')
+
+
+# not state of a connection even if reachable from one
+SHARED = (type, types.ModuleType, types.FunctionType, types.MethodType,
+          types.BuiltinFunctionType)
+
+
+def deep_sizeof(*roots):
+    """ bytes of `roots` and of all objects reachable from them """
+    seen = set()
+    stack = list(roots)
+    size = 0
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, SHARED):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+        if hasattr(obj, '__dict__'):
+            stack.append(vars(obj))
+        for cls in type(obj).__mro__:
+            slots = cls.__dict__.get('__slots__', ())
+            for slot in [slots] if isinstance(slots, str) else slots:
+                if slot not in ('__dict__', '__weakref__') and \
+                        hasattr(obj, slot):
+                    stack.append(getattr(obj, slot))
+    return size
+
+
+class StubSession(object):
+    """ stands in for the tornadio2 session, which is not measured """
+
+
+def open_connections(size, mode):
+    users = options.users or size
+    user_ids = [ObjectId() for _ in range(min(users, size))]
+    connections = []
+    for i in range(size):
+        conn = Connection(StubSession())
+        user_id = user_ids[i % len(user_ids)]
+        username, email = 'user%d' % i, 'user%d@example.com' % i
+        if mode == 'record':
+            conn.user = SessionUser(user_id, username, email)
+        else:
+            conn.user = User(id=user_id, username=username, email=email)
+            conn.user.board_id = None
+        conn.permissions = get_permissions(user_id)
+        Connection.online[conn.user._id].add(conn)
+        presence.join(conn, 'board%d' % (i % options.boards), 'member')
+        connections.append(conn)
+    return connections
+
+
+def close_connections(connections):
+    for conn in connections:
+        presence.leave(conn)
+    Connection.online.clear()
+
+
+def measure(size, mode):
+    """ return bytes held per connection """
+    registries = (Connection.online, presence.boards, presence.wheel)
+    before = deep_sizeof(*registries)
+    connections = open_connections(size, mode)
+    # the list is the benchmark's, the connections in it are counted
+    held = deep_sizeof(connections, *registries) - before - \
+        sys.getsizeof(connections)
+    close_connections(connections)
+    return held / float(size)
+
+
+def main():
+    options.parse_command_line()
+
+    # joins are broadcast to the board, stub connections drop them
+    Connection.emit = lambda self, *args, **kwargs: None
+
+    results = {}
+    for mode in options.modes.split(','):
+        for size in [int(s) for s in options.sizes.split(',')]:
+            per_conn = measure(size, mode)
+            results['%s[%d]' % (mode, size)] = {
+                'bytes_per_conn': per_conn,
+                'total_mb': per_conn * size / 2 ** 20,
+            }
+
+    print_table(results, ('bytes_per_conn', 'total_mb'))
+    if options.output:
+        write_results(options.output, 'memory', results,
+                      sizes=options.sizes, boards=options.boards)
+    if options.baseline:
+        regressions = compare(results, options.baseline, 'bytes_per_conn',
+                              options.threshold)
+        if regressions:
+            print('regressed: %s' % ', '.join(regressions))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
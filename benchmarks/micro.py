@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+Microbenchmarks of per-object hot paths: serialization, queryset values,
+`update_doc`, json encoding and crud event dispatch.
+
+Every benchmark runs on a synthetic board for each size in `--sizes` and
+reports time per operation and bytes allocated per operation. Allocations
+are the peak traced by `tracemalloc` where it is available (python >= 3.4),
+on python 2 they are the growth of the resident set over a first run whose
+results are kept, which also counts one-time caches and misses memory
+reused from earlier runs, so compare them only with runs of the same
+python. The `--db` database is dropped before every size.
+
+    Example usage::
+
+        python benchmarks/micro.py --sizes=10,1000,10000 --output=micro.json
+        python benchmarks/micro.py --baseline=micro.json --threshold=0.1
+"""
+from __future__ import print_function
+
+import gc
+import json
+import os
+import sys
+import time
+
+from tornado.options import define, options
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mongoengine.connection import get_connection
+
+import models
+from models import *
+from utils import ComplexEncoder
+from common import compare, print_table, rss, summarize, write_results
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+define('db', default='cantas_bench', help='throw-away database to use')
+define('sizes', default='10,1000', help='cards per synthetic board')
+define('sample', default=200, help='max objects per run of a benchmark')
+define('repeat', default=5, help='runs of every benchmark')
+define('output', default='', help='write json results to this file')
+define('baseline', default='', help='compare with this results file')
+define('threshold', default=0.1, help='allowed per op time regression')
+
+
+class FakeConnection(object):
+    def emit(self, *args, **kwargs):
+        pass
+
+
+def build_board(size):
+    """ create a board with `size` cards spread over 3 lists, every card has
+    a comment, a vote, a checklist item and every tenth an attachment
+    """
+    user = User.objects.create(username='bench', email='bench@example.com')
+    board = Board.create_default(creator_id=user.id)
+    lists = list(List.objects(boardId=board))
+
+    cards = Card.objects.bulk_insert([
+        Card(title='card %d' % i, description='description ' * 20,
+             order=i, creatorId=user.id, listId=lists[i % len(lists)].id,
+             boardId=board.id, assignees=[user.id])
+        for i in range(size)
+    ])
+    checklists = Checklist.objects.bulk_insert([
+        Checklist(cardId=card.id, authorId=user.id) for card in cards])
+    ChecklistItem.objects.bulk_insert([
+        ChecklistItem(content='item', checked=i % 2 == 0,
+                      checklistId=checklist.id, cardId=card.id,
+                      authorId=user.id)
+        for i, (card, checklist) in enumerate(zip(cards, checklists))
+    ])
+    Comment.objects.bulk_insert([
+        Comment(content='comment ' * 10, cardId=card.id, authorId=user.id)
+        for card in cards])
+    Vote.objects.bulk_insert([
+        Vote(cardId=card.id, authorId=user.id, yesOrNo=i % 3 == 0)
+        for i, card in enumerate(cards)])
+    Attachment.objects.bulk_insert([
+        Attachment(cardId=card.id, uploaderId=user.id, name='a.png',
+                   size=1024, path='a.png', isCover=True)
+        for card in cards[::10]])
+    Activity.objects.bulk_insert([
+        Activity(content='activity %d' % i, creatorId=user.id,
+                 boardId=board.id) for i in range(size)])
+    return user, board
+
+
+def benchmarks(user, board):
+    """ return {name: (function, number of operations it performs)} """
+    sample = options.sample
+    cards = list(Card.objects(boardId=board).limit(sample))
+    comments = list(Comment.objects(cardId__in=cards))
+    payload = Card.objects(boardId=board).limit(sample).values()
+    conn = FakeConnection()
+    list_read = models.crud_event_handlers['list:read']
+
+    return {
+        'MyDocument.to_dict': (
+            lambda: [comment.to_dict() for comment in comments],
+            len(comments)),
+        'Card.to_dict': (
+            lambda: [card.to_dict() for card in cards], len(cards)),
+        'AwesomerQuerySet.values': (
+            lambda: Comment.objects(cardId__in=cards).values(),
+            len(comments)),
+        'AwesomerQuerySet.values(card)': (
+            lambda: Card.objects(boardId=board).limit(sample).values(),
+            len(cards)),
+        'MyDocument.update_doc': (
+            lambda: [card.update_doc(title='updated',
+                                     assignees=[str(user.id)])
+                     for card in cards[:sample // 10 or 1]],
+            len(cards[:sample // 10 or 1])),
+        'ComplexEncoder': (
+            lambda: json.dumps(payload, cls=ComplexEncoder), len(payload)),
+        'models._init_handlers': (models._init_handlers, 1),
+        'crud dispatch list:read': (
+            lambda: list_read(conn, boardId=str(board.id)), 1),
+    }
+
+
+def measure(function, operations):
+    """ return (seconds per op of every run, bytes allocated per op) """
+    if tracemalloc is None:
+        # before the timed runs, which leave freed memory to be reused
+        gc.collect()
+        before = rss()
+        result = function()
+        allocated = max(rss() - before, 0) / float(operations)
+        del result
+
+    timings = []
+    for _ in range(options.repeat):
+        gc.collect()
+        start = time.time()
+        function()
+        timings.append((time.time() - start) / operations)
+
+    if tracemalloc is not None:
+        gc.collect()
+        tracemalloc.start()
+        function()
+        allocated = tracemalloc.get_traced_memory()[1] / float(operations)
+        tracemalloc.stop()
+    return timings, allocated
+
+
+def main():
+    options.parse_command_line()
+    if 'bench' not in options.db:
+        sys.exit('refusing to drop %r, use a database named *bench*' %
+                 options.db)
+
+    connect_db(db=options.db)
+
+    results = {}
+    for size in [int(s) for s in options.sizes.split(',')]:
+        get_connection().drop_database(options.db)
+        user, board = build_board(size)
+        for name, (function, operations) in benchmarks(user, board).items():
+            timings, allocated = measure(function, operations)
+            result = summarize(timings)
+            result['per_op_us'] = result['p50'] * 1000
+            result['alloc_bytes'] = allocated
+            results['%s[%d]' % (name, size)] = result
+
+    print_table(results, ('per_op_us', 'p95', 'alloc_bytes'))
+    if options.output:
+        write_results(options.output, 'micro', results,
+                      sizes=options.sizes, sample=options.sample,
+                      alloc='tracemalloc' if tracemalloc else 'rss')
+    if options.baseline:
+        regressions = compare(results, options.baseline, 'per_op_us',
+                              options.threshold)
+        if regressions:
+            print('regressed: %s' % ', '.join(regressions))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming export of a board with its lists, cards, checklists, comments and
+activities, as json lines or csv.
+
+Documents are read with keyset paging (`_id` > last id) in batches of
+`batch_size`, users they reference are looked up once per batch, and every
+batch is serialized to one chunk, so memory does not grow with the board.
+Every chunk ends at a cursor which can be passed back to resume the export,
+documents after the cursor may be repeated but none are skipped.
+
+    Example usage::
+
+        python export.py <board id> --format=csv --gzip > board.csv.gz
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import sys
+import zlib
+from datetime import datetime
+
+from bson import ObjectId
+
+from models import *
+from models import connect_db
+
+# section -> (document, field referencing the parent, parent is a card)
+SECTIONS = (
+    ('board', Board, '_id', False),
+    ('lists', List, 'boardId', False),
+    ('cards', Card, 'boardId', False),
+    ('checklists', Checklist, 'cardId', True),
+    ('checklistitems', ChecklistItem, 'cardId', True),
+    ('comments', Comment, 'cardId', True),
+    ('activities', Activity, 'boardId', False),
+)
+USER_FIELDS = ('creatorId', 'authorId', 'uploaderId')
+CSV_COLUMNS = ('type', '_id', 'parentId', 'title', 'content', 'creator',
+               'created', 'isArchived', 'cursor')
+
+batch_size = 500
+
+
+def _jsonable(value):
+    if isinstance(value, dict):
+        return dict((k, _jsonable(v)) for k, v in value.items() if k != '_cls')
+    if isinstance(value, list):
+        return [_jsonable(v) for v in value]
+    if isinstance(value, (datetime, ObjectId)):
+        return str(value)
+    return value
+
+
+def _expand_users(records):
+    """ replace user ids of a batch of raw records by user summaries """
+    ids = set(record[field] for record in records for field in USER_FIELDS
+              if record.get(field))
+    users = dict((user['_id'], {'_id': user['_id'],
+                                'username': user.get('username'),
+                                'email': user.get('email')})
+                 for user in User.objects(id__in=list(ids)).only(
+                     'username', 'email').as_pymongo())
+    for record in records:
+        for field in USER_FIELDS:
+            if record.get(field) in users:
+                record[field] = users[record[field]]
+    return records
+
+
+def _keyset(document, after=None, **query):
+    """ yield batches of raw documents matching `query` ordered by id """
+    while True:
+        if after is not None:
+            query['id__gt'] = after
+        batch = list(document.objects(**query).order_by('id').limit(
+            batch_size).as_pymongo())
+        if not batch:
+            return
+        yield batch
+        after = batch[-1]['_id']
+
+
+def is_cursor(cursor):
+    """ return True if `batches()` can resume after `cursor` """
+    start, _, after = cursor.partition(':')
+    return start in [section[0] for section in SECTIONS] and \
+        ':' not in after and (not after or ObjectId.is_valid(after))
+
+
+def batches(board_id, cursor=None):
+    """ yield (section, records, cursor to resume after them) """
+    board_id = ObjectId(board_id)
+    start, after = (cursor or 'board:').split(':')
+    names = [section[0] for section in SECTIONS]
+    after = ObjectId(after) if after else None
+
+    for name, document, parent_field, by_card in \
+            SECTIONS[names.index(start):]:
+        if by_card:
+            # children are exported per batch of cards, cursor is last card
+            for cards in _keyset(Card, after, boardId=board_id):
+                card_ids = [card['_id'] for card in cards]
+                records = list(document.objects(cardId__in=card_ids).order_by(
+                    'cardId', 'id').as_pymongo())
+                yield (name, _expand_users(records),
+                       '%s:%s' % (name, card_ids[-1]))
+        else:
+            for records in _keyset(document, after,
+                                   **{parent_field.lstrip('_'): board_id}):
+                yield (name, _expand_users(records),
+                       '%s:%s' % (name, records[-1]['_id']))
+        after = None
+
+
+def json_lines(board_id, cursor=None):
+    for name, records, next_cursor in batches(board_id, cursor):
+        lines = [json.dumps({'type': name, 'data': _jsonable(record)})
+                 for record in records]
+        lines.append(json.dumps({'type': 'cursor', 'cursor': next_cursor}))
+        yield '\n'.join(lines) + '\n'
+
+
+def _csv_field(value):
+    if value is None:
+        return ''
+    if isinstance(value, dict):
+        value = value.get('username') or value.get('_id')
+    value = u'%s' % (value,)
+    if any(c in value for c in ',"\r\n'):
+        value = u'"%s"' % value.replace('"', '""')
+    return value
+
+
+def csv_rows(board_id, cursor=None):
+    parent_fields = ('boardId', 'listId', 'checklistId', 'cardId')
+    if cursor is None:
+        yield ','.join(CSV_COLUMNS) + '\r\n'
+
+    for name, records, next_cursor in batches(board_id, cursor):
+        rows = []
+        for record in _jsonable(records):
+            parent = next((record[f] for f in parent_fields if f in record),
+                          None)
+            rows.append(','.join(_csv_field(value) for value in (
+                name, record['_id'], parent,
+                record.get('title'),
+                record.get('description', record.get('content')),
+                next((record[f] for f in USER_FIELDS if f in record), None),
+                record.get('created', record.get('createdOn')),
+                record.get('isArchived', record.get('isClosed')),
+                next_cursor)))
+        yield u'\r\n'.join(rows) + u'\r\n'
+
+
+FORMATS = {'json': json_lines, 'csv': csv_rows}
+
+
+def gzipped(chunks):
+    """ gzip a stream of text chunks """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('board', help='id of board to export')
+    parser.add_argument('--format', choices=sorted(FORMATS), default='json')
+    parser.add_argument('--cursor', help='resume after this cursor')
+    parser.add_argument('--gzip', action='store_true')
+    parser.add_argument('--mongo', default='{}',
+                        help='json of models.connect_db() settings')
+    args = parser.parse_args()
+
+    connect_db(**json.loads(args.mongo))
+    chunks = FORMATS[args.format](args.board, args.cursor)
+    output = getattr(sys.stdout, 'buffer', sys.stdout)
+    for chunk in gzipped(chunks) if args.gzip else chunks:
+        output.write(chunk if args.gzip else chunk.encode('utf-8'))
+    output.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,27 +1,46 @@
 # -*- coding: utf8 -*-
 import os
 import json
+import tempfile
 
+from bson import ObjectId
 from mongoengine import DoesNotExist
-from tornado.web import RequestHandler, authenticated, HTTPError
+from tornado.web import (RequestHandler, authenticated, HTTPError,
+                         stream_request_body)
 from tornado import gen
 
-from auth import QQOAuth2Mixin
-from utils import ComplexEncoder
+import profiling
+import export
+import search
+import trello
+from auth import QQOAuth2Mixin, ExpiringCache
+from utils import ComplexEncoder, StreamedUpload
 from models import *
+from models import pending_writes
 
 __all__ = (
     'ArchivedCardsHandler', 'ArchivedListsHandler', 'AttachmentHandler',
-    'ClosedBoardsHandler', 'InvitedBoardsHandler', 'MyBoardsHandler',
-    'Http404Handler', 'LoginHandler', 'LogoutHandler', 'MainHandler',
-    'MyCardsHandler', 'NewBoardHandler', 'OrderCardHandler',
-    'PublicBoardsHandler', 'QQLoginHandler', 'SingleBoardHandler',
-    'SingleCardHandler', 'StandaloneHandler', 'WelcomeHandler',
+    'BoardExportHandler', 'ClosedBoardsHandler', 'InvitedBoardsHandler',
+    'MyBoardsHandler', 'Http404Handler', 'LoginHandler', 'LogoutHandler',
+    'MainHandler', 'MyCardsHandler', 'NewBoardHandler', 'OrderCardHandler',
+    'PublicBoardsHandler', 'QQLoginHandler', 'SearchHandler',
+    'SingleBoardHandler', 'SingleCardHandler', 'StandaloneHandler',
+    'TrelloImportHandler', 'UnreadNotificationsHandler', 'WelcomeHandler',
 )
 
 
 class BaseHandler(RequestHandler):
     """ Abstruct RequestHandler for all others """
+    def prepare(self):
+        self._query_stats = profiling.start(
+            '%s %s' % (self.request.method, self.request.path))
+
+    def on_finish(self):
+        # prepare is skipped by requests failing before it, e.g. with 405
+        stats = getattr(self, '_query_stats', None)
+        if stats is not None:
+            profiling.finish(stats)
+
     def get_current_user(self):
         user_id = self.get_cookie("oid")
         try:
@@ -38,9 +57,15 @@ class BaseHandler(RequestHandler):
 
         return None
 
+    @property
+    def permissions(self):
+        """ boards current user can access, see `models.permissions` """
+        return get_permissions(self.current_user.id)
+
     def set_current_user(self, user):
+        """ `user` is a `User` or the id of one, None logs out """
         if user:
-            self.set_cookie("oid", user._id)
+            self.set_cookie("oid", str(getattr(user, 'id', user)))
         else:
             self.clear_cookie("oid")
 
@@ -57,6 +82,10 @@ class BaseHandler(RequestHandler):
 
 class QQLoginHandler(BaseHandler, QQOAuth2Mixin):
     """ QQ Oauth2 login handler """
+    # openid -> id of user
+    users = ExpiringCache()
+    users_ttl = 3600
+
     @gen.coroutine
     def get(self):
         redirect_uri = 'http://cantas.chifruit.com/auth/qq'
@@ -66,14 +95,15 @@ class QQLoginHandler(BaseHandler, QQOAuth2Mixin):
                 client_id=self.settings['qq_oauth']['key'],
                 client_secret=self.settings['qq_oauth']['secret'],
                 code=self.get_argument('code'))
-            try:
-                user = User.objects.get(openId=qq_user['openid'])
-            except DoesNotExist:
-                user = User.objects.create(
-                    username=qq_user['nickname'],
-                    openId=qq_user['openid']
-                )
-            self.set_current_user(user)
+            user_id = self.users.get(qq_user['openid'])
+            if user_id is None:
+                user = User.objects(openId=qq_user['openid']).only(
+                    'id').first() or User.objects.create(
+                        username=qq_user['nickname'],
+                        openId=qq_user['openid'])
+                user_id = user.id
+                self.users.set(qq_user['openid'], user_id, self.users_ttl)
+            self.set_current_user(user_id)
             self.redirect('/')
         else:
             yield self.authorize_redirect(
@@ -129,6 +159,7 @@ class BoardsHandler(BaseHandler):
     """ base handler for those return a list of boards """
     @authenticated
     def get(self, *args, **kwargs):
+        pending_writes.flush_read(Board, {})
         self.json(self.get_boards().values())
 
     def get_boards(self):
@@ -148,7 +179,7 @@ class PublicBoardsHandler(BoardsHandler):
     """ get all public boards """
     def get_boards(self):
         return Board.objects(isClosed=False,
-                             isPublic=True).order_by('updated')
+                             isPublic=True).order_by('updated').secondary()
 
 
 class ClosedBoardsHandler(BoardsHandler):
@@ -191,6 +222,7 @@ class MyCardsHandler(BaseHandler):
     """ get all my cards """
     @authenticated
     def get(self, *args, **kwargs):
+        pending_writes.flush_read(Card, {'creatorId': self.user.id})
         cards = Card.objects(isArchived=False, creatorId=self.user.id).values()
         for card in cards:
             card['boardId'] = card.boardId.to_dict()
@@ -198,27 +230,88 @@ class MyCardsHandler(BaseHandler):
         self.json(cards)
 
 
+class UnreadNotificationsHandler(BaseHandler):
+    """ get count of my unread notifications """
+    @authenticated
+    def get(self, *args, **kwargs):
+        self.json({'unread': self.user.unreadNotifications})
+
+
 class ArchivedCardsHandler(BaseHandler):
     """ get archived cards of given board """
     @authenticated
     def get(self, board_id, *args, **kwargs):
-        self.json(Card.objects(isArchived=True, boardId=board_id).values())
+        pending_writes.flush_read(Card, {'boardId': board_id})
+        self.json(Card.objects(isArchived=True,
+                               boardId=board_id).secondary().values())
 
 
 class ArchivedListsHandler(BaseHandler):
     """ get archived lists of given board """
     @authenticated
     def get(self, board_id, *args, **kwargs):
-        self.json(List.objects(isArchived=True, boardId=board_id).values())
+        pending_writes.flush_read(List, {'boardId': board_id})
+        self.json(List.objects(isArchived=True,
+                               boardId=board_id).secondary().values())
 
 
 class OrderCardHandler(BaseHandler):
     """ get unarchived cards of given board  """
     @authenticated
     def get(self, list_id, *args, **kwargs):
+        pending_writes.flush_read(Card, {'listId': list_id})
         self.json(Card.objects(listId=list_id, isArchived=False).values())
 
 
+class BoardExportHandler(BaseHandler):
+    """ stream board with its content as json lines or csv """
+    @authenticated
+    @gen.coroutine
+    def get(self, board_id, file_format, *args, **kwargs):
+        cursor = self.get_argument('cursor', None)
+        if not ObjectId.is_valid(board_id) or \
+                cursor is not None and not export.is_cursor(cursor):
+            raise HTTPError(400)
+        if not self.permissions.can_read(board_id):
+            raise HTTPError(403)
+
+        # the export has the board's updates still being coalesced
+        pending_writes.flush_document(Board, board_id)
+        for document in (List, Card):
+            pending_writes.flush_read(document, {'boardId': board_id})
+        for document in (Checklist, ChecklistItem, Comment):
+            pending_writes.flush_read(document, {})
+        chunks = export.FORMATS[file_format](board_id, cursor)
+        self.set_header('Content-Type', 'text/csv; charset=UTF-8'
+                        if file_format == 'csv' else
+                        'application/x-ndjson; charset=UTF-8')
+        self.set_header('Content-Disposition', 'attachment; filename="%s.%s"'
+                        % (board_id, file_format))
+        if 'gzip' in self.request.headers.get('Accept-Encoding', ''):
+            self.set_header('Content-Encoding', 'gzip')
+            chunks = export.gzipped(chunks)
+
+        for chunk in chunks:
+            self.write(chunk)
+            yield self.flush()
+        self.finish()
+
+
+class SearchHandler(BaseHandler):
+    """ search cards and comments of given board """
+    @authenticated
+    def get(self, board_id, *args, **kwargs):
+        try:
+            offset, limit = search.paging(self.get_argument('offset', 0),
+                                          self.get_argument('limit', 20))
+        except (TypeError, ValueError):
+            raise HTTPError(400)
+        if not self.permissions.can_read(board_id):
+            raise HTTPError(403)
+        self.json(search.index.search(
+            board_id, self.get_argument('q', ''), offset, limit))
+
+
 class SingleBoardHandler(BaseHandler):
     @authenticated
     def get(self, board_id, *args, **kwargs):
@@ -282,6 +375,63 @@ class AttachmentHandler(BaseHandler):
         self.json({'attachment': attachment_data})
 
 
+@stream_request_body
+class TrelloImportHandler(BaseHandler):
+    """ the export is streamed to a temporary file as it is received """
+    # exports of big boards are hundreds of megabytes
+    max_export_size = 2 ** 30
+
+    def prepare(self):
+        super(TrelloImportHandler, self).prepare()
+        self.upload = None
+        if self.request.method != 'POST':
+            return
+        # @authenticated of post runs only after the whole body arrived
+        if not self.current_user:
+            raise HTTPError(403)
+        self.request.connection.set_max_body_size(self.max_export_size)
+        self.upload = StreamedUpload(
+            tempfile.NamedTemporaryFile(suffix='.json', delete=False),
+            self.request.headers.get('Content-Type', ''))
+
+    def data_received(self, chunk):
+        if self.upload is None:
+            return
+        try:
+            self.upload.write(chunk)
+        except ValueError:
+            self._discard_upload()
+            raise HTTPError(400)
+
+    def on_connection_close(self):
+        self._discard_upload()
+        super(TrelloImportHandler, self).on_connection_close()
+
+    def _discard_upload(self):
+        if self.upload is not None:
+            self.upload.output.close()
+            os.remove(self.upload.output.name)
+            self.upload = None
+
+    @authenticated
+    def get(self, job_id, *args, **kwargs):
+        """get progress of import job"""
+        if job_id not in trello.jobs:
+            raise HTTPError(404)
+        self.json(trello.jobs[job_id])
+
+    @authenticated
+    def post(self, *args, **kwargs):
+        """import uploaded Trello export in background"""
+        if not self.upload.complete:
+            self._discard_upload()
+            raise HTTPError(400)
+
+        self.upload.output.close()
+        path, self.upload = self.upload.output.name, None
+        self.json({'jobId': trello.start_job(path, self.user.id)})
+
+
 class StandaloneHandler(BaseHandler):
     def get(self, *args, **kwargs):
         self.render('standalone-help.html')
@@ -1,7 +1,12 @@
 # -*- coding: utf-8 -*-
 
 from documents import *
-from base import SockCRUDMixin
+from base import SockCRUDMixin, crud_hooks, ref_id, serialize
+from cascade import delete_orphans
+from connection import connect_db, connection_settings, reconnect_db
+from permissions import get_permissions
+from workingset import card_badges, hot_boards
+from writes import pending_writes
 
 
 def _init_handlers():
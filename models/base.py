@@ -2,18 +2,49 @@
 
 from mongoengine import *
 from bson import ObjectId
+from pymongo import ReturnDocument
 
 from datetime import datetime
 
+from connection import secondary_read_preference
+from writes import pending_writes
+
+
+# callables run as hook(action, obj) after a socket event created, updated
+# or deleted a document, action is 'create', 'update' or 'delete', or
+# 'cascade' with the summary dict of a bulk change under a board as obj,
+# see `models.cascade`
+crud_hooks = []
+
 
 # FIXME: the *args seems never used
 class SockCRUDMixin(object):
     event = ['create', 'read', 'update', 'delete', 'patch']
+    # boolean field archiving the children of the document when set and
+    # restoring them when cleared, deleting the document deletes them
+    cascade_field = None
+
+    @classmethod
+    def _run_hooks(cls, action, obj):
+        for hook in crud_hooks:
+            hook(action, obj)
+
+    @classmethod
+    def _update_doc(cls, conn, obj, data):
+        """ `obj.update_doc(**data)` cascading a change of `cascade_field` """
+        flag = getattr(obj, cls.cascade_field) if cls.cascade_field else None
+        obj = obj.update_doc(**data)
+        if cls.cascade_field and getattr(obj, cls.cascade_field) != flag:
+            from cascade import run
+            run(conn, obj, 'archive' if getattr(obj, cls.cascade_field)
+                else 'restore')
+        return obj
 
     # TODO: generate activity content after creating
     @classmethod
     def _create(cls, conn, *args, **kwargs):
         obj = cls.objects.create(**kwargs)
+        cls._run_hooks('create', obj)
         conn.emit('/%s:create' % cls.__name__.lower(), obj.to_dict())
         return obj.to_dict()
 
@@ -21,7 +52,7 @@ class SockCRUDMixin(object):
     def _read(cls, conn, *args, **kwargs):
         try:
             if '_id' in kwargs:
-                return cls.objects.get(kwargs['_id']).to_dict()
+                return cls.objects.get(id=kwargs['_id']).to_dict()
             return cls.objects(**kwargs).values()
         except:
             return None
@@ -29,28 +60,53 @@ class SockCRUDMixin(object):
     @classmethod
     def _update(cls, conn, *args, **kwargs):
         object_id = kwargs.pop('_id')
-        obj = cls.objects.get(id=object_id)
-        obj = obj.update_doc(**kwargs)
-        conn.emit('/%s/%s:update' % (cls.__name__.lower(), object_id),
-                  obj.to_dict())
+        pending_writes.add(cls, conn, object_id, kwargs)
         return None
 
+    @classmethod
+    def _write(cls, conns, object_id, data):
+        """ write fields coalesced from update events of `conns` and emit
+        the changed fields with the new version, clients wanting the whole
+        document read it with `_id`
+        """
+        obj = cls.objects.get(id=object_id)
+        before = obj.to_mongo().to_dict()
+        data.pop('version', None)
+        obj = cls._update_doc(conns[-1], obj, data)
+        # incremented in the database, concurrent writers of other processes
+        # never get the same version
+        obj.version = cls._get_collection().find_one_and_update(
+            {'_id': obj.id}, {'$inc': {'__v': 1}}, projection={'__v': True},
+            return_document=ReturnDocument.AFTER)['__v']
+        cls._run_hooks('update', obj)
+        after = obj.to_mongo().to_dict()
+        # cleared fields are left out of `after` and sent as None
+        payload = serialize(dict(
+            (k, after.get(k)) for k in set(before) | set(after)
+            if before.get(k) != after.get(k)))
+        payload['_id'] = str(obj.id)
+        for conn in conns:
+            conn.emit('/%s/%s:update' % (cls.__name__.lower(), object_id),
+                      payload)
+
     @classmethod
     def _delete(cls, conn, *args, **kwargs):
         object_id = kwargs.pop('_id')
+        pending_writes.flush_document(cls, object_id)
         obj = cls.objects.get(id=object_id)
         conn.emit('/%s/%s:delete' % (cls.__name__.lower(), object_id),
                   obj.to_dict())
         obj.delete()
+        cls._run_hooks('delete', obj)
+        if cls.cascade_field:
+            from cascade import run
+            run(conn, obj, 'delete')
         return None
 
     @classmethod
     def _patch(cls, conn, *args, **kwargs):
         object_id = kwargs.pop('id')
-        obj = cls.objects.get(id=object_id)
-        obj = obj.update_doc(**kwargs)
-        conn.emit('/%s/%s:update' % (cls.__name__.lower(), object_id),
-                  obj.to_dict())
+        pending_writes.add(cls, conn, object_id, kwargs)
         return None
 
 
@@ -66,8 +122,31 @@ class AwesomerQuerySet(QuerySet):
         # FIXME: this could be more efficient
         return self.count() > 0
 
-    def values(self):
-        return [obj.to_dict() for obj in self]
+    def values(self, *expand):
+        """ serialize all documents, `expand` names reference fields to be
+        replaced by the referenced documents, fetched in one query per field
+        """
+        data = [obj.to_dict() for obj in self]
+        for field_name in expand:
+            expand_references(data, field_name,
+                              self._document._fields[field_name].document_type)
+        return data
+
+    def secondary(self):
+        """ allow a secondary to serve the query, for lag tolerant reads """
+        return self.read_preference(secondary_read_preference())
+
+    def bulk_insert(self, docs):
+        """ insert `docs` with a single write, skipping validation, and set
+        the generated ids on them
+        """
+        if not docs:
+            return docs
+
+        ids = self._collection.insert([doc.to_mongo() for doc in docs])
+        for doc, _id in zip(docs, ids):
+            doc.id = _id
+        return docs
 
     def __add__(self, other):
         """ perform union on two queryset """
@@ -75,6 +154,48 @@ class AwesomerQuerySet(QuerySet):
         return self._document.objects(id__in=ids)
 
 
+def ref_id(value):
+    """ id of a reference field value, without dereferencing it """
+    return getattr(value, 'id', value)
+
+
+def expand_references(data, field_name, document):
+    """ replace ids in `field_name` of serialized `data` with dicts of
+    `document`, using a single query, only `_id` and `public_fields` of
+    documents which declare them are included
+    """
+    ids = set(ObjectId(item[field_name]) for item in data
+              if item.get(field_name) and
+              not isinstance(item[field_name], dict))
+    if not ids:
+        return data
+
+    fields = getattr(document, 'public_fields', None)
+    objs = document.objects.in_bulk(list(ids))
+    for item in data:
+        value = item.get(field_name)
+        if value and not isinstance(value, dict) and \
+                ObjectId(value) in objs:
+            obj = objs[ObjectId(value)].to_dict()
+            if fields:
+                obj = dict((k, obj.get(k)) for k in ('_id',) + fields)
+            item[field_name] = obj
+    return data
+
+
+def serialize(data):
+    """ dict of raw document fields `data` with ids and dates as strings """
+    data = dict(data)
+    for k, v in data.items():
+        if isinstance(v, (datetime, ObjectId)):
+            data[k] = str(v)
+        if isinstance(v, list):
+            data[k] = [str(o) for o in v]
+
+    data.pop('_cls', None)
+    return data
+
+
 class MyDocument(Document):
     """ Abstruct document class """
     meta = {
@@ -82,6 +203,9 @@ class MyDocument(Document):
         'abstract': True,
         'queryset_class': AwesomerQuerySet
     }
+    # incremented by every write of socket update events, stored like the
+    # mongoose version key of the original cantas
+    version = IntField(default=0, db_field='__v')
 
     def save(self, *args, **kwargs):
         for field_name in self:
@@ -96,15 +220,7 @@ class MyDocument(Document):
         return str(self.id)
 
     def to_dict(self):
-        data = dict(self.to_mongo())
-
-        for k, v in data.items():
-            if isinstance(v, (datetime, ObjectId)):
-                data[k] = str(v)
-            if isinstance(v, list):
-                data[k] = [str(o) for o in v]
-
-        data.pop('_cls')
+        data = serialize(self.to_mongo())
         data['_id'] = str(data['_id'])
         return data
 
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+Bulk archive, restore and delete of board and list subtrees.
+
+Every cascade is a handful of multi-document updates or deletes per
+collection, children of cards are matched by chunks of `chunk_size` card
+ids. Cards and lists archived by a cascade remember the board or list in
+`archivedWith`, so restoring it unarchives only what the cascade archived.
+
+Cascades over more than `background_threshold` cards run on a worker
+thread. When done, crud hooks are run with action 'cascade' and the summary
+is emitted to the connection as '/<list|board>/<id>:cascade'.
+"""
+from itertools import islice
+
+from tornado import ioloop
+
+from base import SockCRUDMixin, ref_id
+from writes import pending_writes
+import documents as docs
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    ThreadPoolExecutor = None
+
+background_threshold = 1000
+chunk_size = 1000
+
+_executor = None
+
+
+def _chunks(ids):
+    ids = iter(ids)
+    while True:
+        chunk = list(islice(ids, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _distinct(collection, field):
+    """ distinct values of `field`, streamed from an aggregation instead of
+    returned in a single document like by `distinct`, which is limited to
+    16MB
+    """
+    for group in collection.aggregate([{'$group': {'_id': '$' + field}}],
+                                      allowDiskUse=True):
+        if group['_id'] is not None:
+            yield group['_id']
+
+
+def _scope(root, root_id):
+    """ query of the cards and lists under `root` """
+    field = 'listId' if root == 'list' else 'boardId'
+    return {field: root_id}
+
+
+def archive(root, root_id, archive_cards_only=False):
+    """ archive unarchived cards (and lists of a board) under `root` """
+    counts = {}
+    update = {'set__isArchived': True}
+    if not archive_cards_only:
+        update['set__archivedWith'] = root_id
+    counts['Card'] = docs.Card.objects(
+        isArchived=False, **_scope(root, root_id)).update(**update)
+    if root == 'board':
+        counts['List'] = docs.List.objects(
+            boardId=root_id, isArchived=False
+        ).update(set__isArchived=True, set__archivedWith=root_id)
+    return counts
+
+
+def restore(root, root_id):
+    """ unarchive what archiving `root` archived """
+    counts = {}
+    for document in (docs.Card, docs.List):
+        counts[document.__name__] = document.objects(
+            archivedWith=root_id
+        ).update(set__isArchived=False, unset__archivedWith=True)
+    return counts
+
+
+def delete(root, root_id):
+    """ delete everything under `root`, but not `root` itself """
+    counts = {}
+    card_ids = list(docs.Card.objects(
+        **_scope(root, root_id)).scalar('id'))
+    for ids in _chunks(card_ids):
+        for document in (docs.Attachment, docs.CardLabelRelation,
+                         docs.CardSourceRelation, docs.Checklist,
+                         docs.ChecklistItem, docs.Comment,
+                         docs.CommentSourceRelation, docs.Vote):
+            counts[document.__name__] = counts.get(document.__name__, 0) + \
+                document.objects(cardId__in=ids).delete()
+    counts['Card'] = docs.Card.objects(**_scope(root, root_id)).delete()
+
+    if root == 'board':
+        config_ids = list(docs.SyncConfig.objects(
+            boardId=root_id).scalar('id'))
+        counts['CardSourceRelation'] = counts.get('CardSourceRelation', 0) + \
+            docs.CardSourceRelation.objects(
+                syncConfigId__in=config_ids).delete()
+        for document in (docs.Activity, docs.BoardMemberRelation,
+                         docs.CardLabelRelation, docs.Label, docs.List,
+                         docs.SyncConfig):
+            counts[document.__name__] = counts.get(document.__name__, 0) + \
+                document.objects(boardId=root_id).delete()
+    return counts
+
+
+ACTIONS = {
+    'archive': archive,
+    'archive_cards': lambda root, root_id: archive(root, root_id, True),
+    'restore': restore,
+    'delete': delete,
+}
+
+
+def run(conn, obj, action):
+    """ run cascade `action` under board or list `obj` """
+    global _executor
+
+    # updates coalesced before the cascade must not undo it
+    pending_writes.flush()
+    root = type(obj).__name__.lower()
+    board_id = obj.id if root == 'board' else ref_id(obj._data['boardId'])
+    summary = {'action': action, 'root': root, '_id': str(obj.id),
+               'boardId': str(board_id)}
+
+    def done(counts):
+        summary['counts'] = counts
+        SockCRUDMixin._run_hooks('cascade', summary)
+        conn.emit('/%s/%s:cascade' % (root, obj.id), summary)
+
+    work = lambda: ACTIONS[action](root, obj.id)
+    if ThreadPoolExecutor is None or docs.Card.objects(
+            **_scope(root, obj.id)).count() <= background_threshold:
+        done(work())
+        return
+
+    if _executor is None:
+        _executor = ThreadPoolExecutor(2)
+    io_loop = ioloop.IOLoop.current()
+    io_loop.add_future(_executor.submit(work),
+                       lambda future: done(future.result()))
+
+
+def delete_orphans():
+    """ delete children of cards, lists and boards which no longer exist,
+    return counts of deleted documents, takes a while on big collections
+    and is best run off the IOLoop
+    """
+    counts = {}
+    for parent, field, children in (
+            (docs.Card, 'cardId', (
+                docs.Attachment, docs.CardLabelRelation,
+                docs.CardSourceRelation, docs.Checklist, docs.ChecklistItem,
+                docs.Comment, docs.CommentSourceRelation, docs.Vote)),
+            (docs.List, 'listId', (docs.Card,)),
+            (docs.Board, 'boardId', (
+                docs.Activity, docs.BoardMemberRelation, docs.Label,
+                docs.List, docs.SyncConfig))):
+        for document in children:
+            collection = document._get_collection()
+            for ids in _chunks(_distinct(collection, field)):
+                existing = set(parent.objects(id__in=ids).scalar('id'))
+                orphaned = [i for i in ids if i not in existing]
+                if orphaned:
+                    counts[document.__name__] = \
+                        counts.get(document.__name__, 0) + \
+                        collection.delete_many(
+                            {field: {'$in': orphaned}}).deleted_count
+    return counts
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""
+Mongo connection settings.
+
+Nothing connects at import time: `connect_db()` only registers settings and
+the connection is created by the first query. Besides `db`, settings are
+keyword arguments of pymongo's `MongoClient`, e.g. `host`, `maxPoolSize`,
+`connectTimeoutMS`, `serverSelectionTimeoutMS`, `compressors` or
+`replicaSet`.
+
+Querysets of read-only, lag tolerant listings can be sent to secondaries
+with `AwesomerQuerySet.secondary()`. To try it locally, run a single node
+replica set (`mongod --replSet rs0`, then `rs.initiate()` in the shell) and
+start the app with `--mongo_host=mongodb://localhost/?replicaSet=rs0`.
+"""
+from mongoengine.base import _document_registry
+from mongoengine.connection import disconnect, register_connection
+from pymongo import ReadPreference
+
+_settings = {'db': 'cantas'}
+_secondary_read_preference = ReadPreference.SECONDARY_PREFERRED
+
+
+def connect_db(secondary_preference=None, **settings):
+    """ (re)register the default connection, `settings` update the current
+    ones and the connection is created again on next query
+
+    `secondary_preference` is the name of the pymongo read preference
+    used by `secondary()` querysets, e.g. 'secondary_preferred' or 'nearest'
+    """
+    global _secondary_read_preference
+
+    _settings.update(settings)
+    if secondary_preference:
+        _secondary_read_preference = getattr(ReadPreference,
+                                             secondary_preference.upper())
+
+    kwargs = dict(_settings)
+    disconnect()
+    register_connection('default', name=kwargs.pop('db'), **kwargs)
+    # documents cache their collection, which belongs to the old connection
+    for document in _document_registry.values():
+        document._collection = None
+
+
+def connection_settings():
+    """ settings `connect_db()` was last called with """
+    return dict(_settings)
+
+
+def reconnect_db():
+    """ drop current connection, e.g. one inherited through fork """
+    connect_db()
+
+
+def secondary_read_preference():
+    return _secondary_read_preference
@@ -1,8 +1,14 @@
 # -*- coding: utf8 -*-
 
+from datetime import datetime, timedelta
+
 from mongoengine import *
+from pymongo import UpdateOne
 
-from base import MyDocument, AutonowDatetimeField, SockCRUDMixin
+from base import MyDocument, AutonowDatetimeField, SockCRUDMixin, ref_id
+from connection import connect_db
+from workingset import hot_boards
+import permissions
 
 
 __all__ = ('Action', 'Activity', 'Attachment', 'Board', 'BoardMemberRelation',
@@ -11,7 +17,7 @@ __all__ = ('Action', 'Activity', 'Attachment', 'Board', 'BoardMemberRelation',
            'Label', 'List', 'LabelMetadata', 'Notification', 'Organization',
            'Permission', 'Role', 'SyncConfig', 'User', 'Vote')
 
-connect('cantas')
+connect_db()
 
 
 class _Perm(EmbeddedDocument):
@@ -33,11 +39,70 @@ class Action(MyDocument):
 
 class Activity(MyDocument,
                SockCRUDMixin):
+    page_size = 30
+
     content = StringField(required=True)
     creatorId = ReferenceField('User')
     boardId = ReferenceField('Board')
     createdOn = AutonowDatetimeField()
 
+    meta = {
+        'indexes': [('boardId', '-createdOn', '-id')]
+    }
+
+    @classmethod
+    def get_page(cls, board_id, before=None, limit=None):
+        """ return the latest `limit` activities of board, newest first, or
+        all of them without `limit`, `compact` bounds how many that is
+
+        `before` is the id of the oldest activity client already has, only
+        activities older than it are returned
+        """
+
+        query = Q(boardId=board_id)
+        if before:
+            try:
+                cursor = cls.objects.only('createdOn').get(id=before)
+            except (DoesNotExist, ValidationError):
+                return []
+            query &= (Q(createdOn__lt=cursor.createdOn) |
+                      Q(createdOn=cursor.createdOn, id__lt=cursor.id))
+
+        activities = cls.objects(query).order_by('-createdOn', '-id')
+        if limit:
+            activities = activities.limit(min(limit, cls.page_size * 10))
+        return activities.values('creatorId')
+
+    @classmethod
+    def compact(cls, keep=1000, max_age_days=None):
+        """ drop activities older than `max_age_days` and keep at most `keep`
+        latest activities for every board, 0 disables either
+        """
+
+        if max_age_days:
+            cls.objects(
+                createdOn__lt=datetime.now() - timedelta(days=max_age_days)
+            ).delete()
+        if not keep:
+            return
+
+        for board_id in cls._get_collection().distinct('boardId'):
+            # the newest activity to drop, in the order pages are read
+            cutoff = cls.objects(boardId=board_id).order_by(
+                '-createdOn', '-id').skip(keep).only('createdOn').first()
+            if cutoff:
+                cls.objects(Q(boardId=board_id) & (
+                    Q(createdOn__lt=cutoff.createdOn) |
+                    Q(createdOn=cutoff.createdOn, id__lte=cutoff.id)
+                )).delete()
+
+    @classmethod
+    def _read(cls, conn, *args, **kwargs):
+        if '_id' in kwargs:
+            return super(Activity, cls)._read(conn, *args, **kwargs)
+        return cls.get_page(kwargs['boardId'], kwargs.get('before'),
+                            int(kwargs.get('limit') or 0) or None)
+
 
 class Attachment(MyDocument,
                  SockCRUDMixin):
@@ -52,6 +117,10 @@ class Attachment(MyDocument,
     cardDetailThumbPath = StringField(default='')
     createdOn = AutonowDatetimeField()
 
+    meta = {
+        'indexes': ['cardId']
+    }
+
     def to_dict(self):
         data = super(Attachment, self).to_dict()
         data['uploaderId'] = self.uploaderId.to_dict()
@@ -75,12 +144,31 @@ class Board(MyDocument,
     voteStatus = StringField(default='enabled')
     commentStatus = StringField(default='enabled')
     perms = EmbeddedDocumentField(Perm)
+    cascade_field = 'isClosed'
 
     def to_dict(self):
         data = super(Board, self).to_dict()
         data['creatorId'] = self.creatorId.to_dict()
         return data
 
+    def save(self, *args, **kwargs):
+        changed = self.id is None or \
+            'creatorId' in self._get_changed_fields()
+        super(Board, self).save(*args, **kwargs)
+        if changed:
+            self._invalidate_permissions()
+        return self
+
+    def delete(self, *args, **kwargs):
+        self._invalidate_permissions()
+        super(Board, self).delete(*args, **kwargs)
+
+    def _invalidate_permissions(self):
+        permissions.invalidate(
+            ref_id(self._data['creatorId']),
+            *BoardMemberRelation.get_board_member_ids(self.id)
+        )
+
     @classmethod
     def create_default(cls, creator_id):
         """ create board using default name and create default lists in board """
@@ -117,14 +205,20 @@ class BoardMemberRelation(MyDocument,
     quitOn = DateTimeField()  # FIXME
     status = StringField(default=member_status['available'])
 
+    def save(self, *args, **kwargs):
+        super(BoardMemberRelation, self).save(*args, **kwargs)
+        permissions.invalidate(ref_id(self._data['userId']))
+        return self
+
+    def delete(self, *args, **kwargs):
+        super(BoardMemberRelation, self).delete(*args, **kwargs)
+        permissions.invalidate(ref_id(self._data['userId']))
+
     @classmethod
     def is_board_member(cls, user_id, board_id):
         """return True if user is member of board or user is creator"""
 
-        return cls.objects(
-            Q(userId=user_id) & Q(boardId=board_id) &
-            (Q(status='inviting') | Q(status='available'))
-        ).exists() or Board.objects.get(id=board_id).creatorId._id == user_id
+        return board_id in permissions.get_permissions(user_id)
 
     @classmethod
     def revoke(cls, user_id, board_id):
@@ -137,6 +231,14 @@ class BoardMemberRelation(MyDocument,
             (Q(status='inviting') | Q(status='available'))
         )]
 
+    @classmethod
+    def get_board_member_ids(cls, board_id):
+        """ like `get_board_members`, but only ids and without dereferencing """
+        return [relation['userId'] for relation in cls.objects(
+            Q(boardId=board_id) &
+            (Q(status='inviting') | Q(status='available'))
+        ).only('userId').as_pymongo()]
+
     @classmethod
     def get_invited_boards_by_member(cls, user_id):
         board_ids = [relation.boardId.id for relation in
@@ -152,10 +254,7 @@ class BoardMemberRelation(MyDocument,
             for condition in kwargs.pop('$or'):
                 q |= Q(**condition)
             query_set = query_set.filter(q)
-        result = query_set.filter(**kwargs).values()
-        for obj in result:
-            obj['userId'] = User.objects.get(id=obj['userId']).to_dict()
-        return result
+        return query_set.filter(**kwargs).values('userId')
 
 
 class Card(MyDocument,
@@ -172,6 +271,13 @@ class Card(MyDocument,
     listId = ReferenceField('List', required=True)
     boardId = ReferenceField('Board', required=True)
     subscribeUserIds = ListField(ReferenceField('User'))
+    # board or list whose archiving archived the card
+    archivedWith = ObjectIdField()
+
+    meta = {
+        'indexes': ['listId', 'boardId', 'updated',
+                    {'fields': ['archivedWith'], 'sparse': True}]
+    }
 
     def to_dict(self):
         data = super(Card, self).to_dict()
@@ -216,12 +322,16 @@ class Card(MyDocument,
     def _read(cls, conn, *args, **kwargs):
         if '$query' in kwargs:
             kwargs = kwargs.pop('$query')
+        cards = hot_boards.cards(kwargs)
+        if cards is not None:
+            return cards
         return cls.objects(**kwargs).values()
 
     @classmethod
     def _create(cls, conn, *args, **kwargs):
         kwargs.update(creatorId=conn.user.id)
         card = cls.objects.create(**kwargs)
+        cls._run_hooks('create', card)
         conn.emit('/card:create', card.to_dict())
         return []
 
@@ -235,6 +345,10 @@ class CardLabelRelation(MyDocument,
     createdOn = AutonowDatetimeField()
     updatedOn = AutonowDatetimeField(auto_now_update=True)
 
+    meta = {
+        'indexes': ['cardId']
+    }
+
 
 class CardSourceRelation(MyDocument):
     syncConfigId = ReferenceField('SyncConfig', required=True)
@@ -243,6 +357,10 @@ class CardSourceRelation(MyDocument):
     sourceType = StringField(required=True)
     lastSyncTime = AutonowDatetimeField()
 
+    meta = {
+        'indexes': [('syncConfigId', 'sourceId')]
+    }
+
 
 class Checklist(MyDocument,
                 SockCRUDMixin):
@@ -252,6 +370,10 @@ class Checklist(MyDocument,
     createdOn = AutonowDatetimeField()
     updatedOn = AutonowDatetimeField(auto_now_update=True)
 
+    meta = {
+        'indexes': ['cardId']
+    }
+
 
 class ChecklistItem(MyDocument,
                     SockCRUDMixin):
@@ -264,6 +386,10 @@ class ChecklistItem(MyDocument,
     createdOn = AutonowDatetimeField()
     updatedOn = AutonowDatetimeField(auto_now_update=True)
 
+    meta = {
+        'indexes': ['cardId']
+    }
+
 
 class Comment(MyDocument,
               SockCRUDMixin):
@@ -273,6 +399,10 @@ class Comment(MyDocument,
     createdOn = AutonowDatetimeField()
     updatedOn = AutonowDatetimeField(auto_now_update=True)
 
+    meta = {
+        'indexes': ['cardId', 'updatedOn']
+    }
+
 
 class CommentSourceRelation(MyDocument):
     commentId = ReferenceField('Comment', required=True)
@@ -281,6 +411,10 @@ class CommentSourceRelation(MyDocument):
     sourceType = StringField(required=True)
     lastSyncTime = AutonowDatetimeField()
 
+    meta = {
+        'indexes': [('cardId', 'sourceId')]
+    }
+
 
 class Group(MyDocument):
     name = StringField(required=True)
@@ -306,9 +440,28 @@ class List(MyDocument,
     order = IntField(default=-1)
     boardId = ReferenceField('Board', required=True)
     perms = EmbeddedDocumentField(Perm)
+    # board whose closing archived the list
+    archivedWith = ObjectIdField()
+    cascade_field = 'isArchived'
+
+    meta = {
+        'indexes': ['boardId', {'fields': ['archivedWith'], 'sparse': True}]
+    }
+
+    @classmethod
+    def _patch(cls, conn, *args, **kwargs):
+        if kwargs.pop('_archiveAllCards', False):
+            from cascade import run
+            run(conn, cls.objects.get(id=kwargs['id']), 'archive_cards')
+            if len(kwargs) == 1:
+                return None
+        return super(List, cls)._patch(conn, *args, **kwargs)
 
     @classmethod
     def _read(cls, conn, *args, **kwargs):
+        lists = hot_boards.lists(kwargs['boardId'])
+        if lists is not None:
+            return lists
         return cls.objects(boardId=kwargs['boardId']).values()
 
 
@@ -334,6 +487,81 @@ class Notification(MyDocument,
     isUnread = BooleanField(default=True)
     created = AutonowDatetimeField()
 
+    meta = {
+        'indexes': [('userId', 'isUnread', '-created')]
+    }
+
+    @classmethod
+    def notify(cls, user_ids, message,
+               type=notification_type['information']):
+        """ create a notification for every user with one insert and bump
+        their unread counters with one update
+        """
+
+        user_ids = list(set(user_ids))
+        notifications = cls.objects.bulk_insert([
+            cls(userId=user_id, massage=message, type=type)
+            for user_id in user_ids
+        ])
+        User.objects(id__in=user_ids).update(inc__unreadNotifications=1)
+        return notifications
+
+    @classmethod
+    def mark_all_read(cls, user_id):
+        # not reset to 0, notifications may be created meanwhile
+        read = cls.objects(userId=user_id, isUnread=True).update(
+            set__isUnread=False)
+        if read:
+            User.objects(id=user_id).update_one(
+                dec__unreadNotifications=read)
+            User.objects(id=user_id, unreadNotifications__lt=0).update_one(
+                set__unreadNotifications=0)
+
+    @classmethod
+    def backfill_unread(cls):
+        """ set `User.unreadNotifications` of users with unread notifications
+        to their count, for notifications created before the counter
+        """
+
+        updates = [
+            UpdateOne({'_id': group['_id'],
+                       'unreadNotifications': {'$ne': group['n']}},
+                      {'$set': {'unreadNotifications': group['n']}})
+            for group in cls._get_collection().aggregate([
+                {'$match': {'isUnread': True}},
+                {'$group': {'_id': '$userId', 'n': {'$sum': 1}}}])
+        ]
+        if updates:
+            User._get_collection().bulk_write(updates, ordered=False)
+
+    def save(self, *args, **kwargs):
+        """ keep `User.unreadNotifications` in step with `isUnread` """
+
+        delta = 0
+        if self.id is None:
+            delta = int(self.isUnread)
+        elif 'isUnread' in self._get_changed_fields():
+            delta = 1 if self.isUnread else -1
+
+        super(Notification, self).save(*args, **kwargs)
+        if delta > 0:
+            User.objects(id=ref_id(self._data['userId'])).update_one(
+                inc__unreadNotifications=1)
+        elif delta < 0:
+            self._decrement_unread()
+        return self
+
+    def delete(self, *args, **kwargs):
+        super(Notification, self).delete(*args, **kwargs)
+        if self.isUnread:
+            self._decrement_unread()
+
+    def _decrement_unread(self):
+        # never below zero, should the counter have missed an increment
+        User.objects(id=ref_id(self._data['userId']),
+                     unreadNotifications__gt=0).update_one(
+                         dec__unreadNotifications=1)
+
 
 class Organization(MyDocument):
     name = StringField()
@@ -360,13 +588,17 @@ class SyncConfig(MyDocument,
     queryUrl = StringField()
     queryType = StringField(required=True)
     isActive = BooleanField(default=True)
-    intervalTime = IntField(default=8)
+    intervalTime = IntField(default=8)  # minutes
+    lastSyncTime = DateTimeField()
     creatorId = ReferenceField('User', required=True)
     createdOn = AutonowDatetimeField()
     updatedOn = AutonowDatetimeField(auto_now_update=True)
 
 
 class User(MyDocument):
+    # what other users may see of a user, see `expand_references`
+    public_fields = ('username', 'fullname', 'email')
+
     username = StringField(required=True)
     fullname = StringField(default='')
     password = StringField(default='')
@@ -375,6 +607,7 @@ class User(MyDocument):
     isFirstLogin = BooleanField(default=True)
     roles = ListField(ReferenceField('Role'))
     openId = StringField(unique=True, required=False, default='')
+    unreadNotifications = IntField(default=0)
 
 
 class Vote(MyDocument,
@@ -385,8 +618,13 @@ class Vote(MyDocument,
     createdOn = AutonowDatetimeField()
     updatedOn = AutonowDatetimeField(auto_now_update=True)
 
+    meta = {
+        'indexes': ['cardId']
+    }
+
     @classmethod
     def _create(cls, conn, *args, **kwargs):
         vote = cls.objects.create(**kwargs)
+        cls._run_hooks('create', vote)
         conn.emit('/vote:create', vote.to_dict())
         return 'Can not vote', vote.to_dict()
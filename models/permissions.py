@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+Per-user cache of boards the user can access, so permission checks on hot
+paths are dict lookups instead of queries.
+
+The cache of a user is shared by all their socket connections and http
+requests, it is invalidated when their `BoardMemberRelation`s or the
+creators of their boards change. Entries also expire after `ttl`
+seconds, which bounds staleness of changes made by other processes.
+"""
+import time
+from collections import OrderedDict
+
+ADMIN = 'admin'
+MEMBER = 'member'
+INVITED = 'invited'
+
+
+class BoardPermissions(object):
+    """ ids of boards a user can access, mapped to the user's role on it """
+    ttl = 60
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self._boards = None
+        self._loaded = 0
+
+    @property
+    def boards(self):
+        if self._boards is None or time.time() - self._loaded > self.ttl:
+            self._load()
+        return self._boards
+
+    def invalidate(self):
+        self._boards = None
+
+    def __contains__(self, board_id):
+        return str(board_id) in self.boards
+
+    def role(self, board_id):
+        """ return 'admin', 'member', 'invited' or None """
+        return self.boards.get(str(board_id))
+
+    def can_read(self, board_id):
+        """ return True if user is a member of board or the board is public """
+        if self.role(board_id) in (ADMIN, MEMBER):
+            return True
+        from bson import ObjectId
+        from documents import Board
+
+        if not ObjectId.is_valid(str(board_id)):
+            return False
+        board = Board.objects(id=board_id).only(
+            'isPublic').as_pymongo().first()
+        return board is not None and board.get('isPublic', True)
+
+    def _load(self):
+        from mongoengine import Q
+        from documents import Board, BoardMemberRelation
+
+        roles = {}
+        for relation in BoardMemberRelation.objects(
+                userId=self.user_id, status__in=('available', 'inviting')
+        ).only('boardId', 'status').as_pymongo():
+            roles[relation['boardId']] = (
+                MEMBER if relation['status'] == 'available' else INVITED)
+
+        boards = {}
+        for board in Board.objects(
+                Q(creatorId=self.user_id) | Q(id__in=list(roles))
+        ).only('creatorId').as_pymongo():
+            boards[str(board['_id'])] = \
+                ADMIN if str(board['creatorId']) == self.user_id \
+                else roles[board['_id']]
+
+        self._boards = boards
+        self._loaded = time.time()
+
+
+_cache = OrderedDict()
+max_users = 10000
+
+
+def get_permissions(user_id):
+    """ return the shared `BoardPermissions` of user """
+    user_id = str(user_id)
+    permissions = _cache.pop(user_id, None) or BoardPermissions(user_id)
+    _cache[user_id] = permissions
+    if len(_cache) > max_users:
+        _cache.popitem(last=False)
+    return permissions
+
+
+def invalidate(*user_ids):
+    for user_id in user_ids:
+        permissions = _cache.get(str(user_id))
+        if permissions is not None:
+            permissions.invalidate()
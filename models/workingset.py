@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+"""
+In-process working set of hot boards.
+
+A board is loaded on 'join-board' into compact records: serialized lists,
+and cards without the board and list metadata `Card.to_dict()` repeats in
+every card, those are attached when a card is read. Card badges and covers
+are counted with one aggregation per collection instead of per card.
+`list:read` and `card:read` of a loaded board are served from the records,
+socket events keep them up to date through a crud hook while writes still
+go to the database.
+
+Boards are evicted least recently joined or read first to stay within
+`budget` bytes (0 disables the working set). A board read when its records
+are older than `max_age` seconds is rebuilt before it is served, which
+bounds staleness from writes of other processes, of http handlers or of
+the sync scheduler.
+"""
+import sys
+import time
+from collections import OrderedDict
+
+from base import crud_hooks, ref_id, serialize
+
+EMPTY_BADGES = {'votesNo': 0, 'votesYes': 0, 'comments': 0,
+                'attachments': 0, 'checkitems': 0, 'checkitemsChecked': 0}
+
+
+def _sizeof(value):
+    """ rough deep size of a record """
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(_sizeof(k) + _sizeof(v) for k, v in value.items())
+    elif isinstance(value, list):
+        size += sum(_sizeof(v) for v in value)
+    return size
+
+
+def _count(document, card_ids, flag=None):
+    """ {(card id, value of `flag` field): count} of documents of cards """
+    key = {'card': '$cardId'}
+    if flag:
+        key['flag'] = '$' + flag
+    return dict(
+        ((str(group['_id']['card']), group['_id'].get('flag')), group['n'])
+        for group in document._get_collection().aggregate([
+            {'$match': {'cardId': {'$in': card_ids}}},
+            {'$group': {'_id': key, 'n': {'$sum': 1}}}]))
+
+
+def card_badges(card_ids):
+    """ {card id: (badges, cover)} like `Card.get_badges()` and
+    `Card.get_cover()` of every card, in a few queries
+    """
+    from documents import Attachment, ChecklistItem, Comment, Vote
+
+    votes = _count(Vote, card_ids, 'yesOrNo')
+    comments = _count(Comment, card_ids)
+    attachments = _count(Attachment, card_ids)
+    items = _count(ChecklistItem, card_ids, 'checked')
+    covers = dict(
+        (str(a['cardId']), a.get('cardThumbPath') or a['path'])
+        for a in Attachment.objects(cardId__in=card_ids, isCover=True).only(
+            'cardId', 'path', 'cardThumbPath').as_pymongo())
+
+    result = {}
+    for card_id in map(str, card_ids):
+        checked = items.get((card_id, True), 0)
+        result[card_id] = ({
+            'votesNo': votes.get((card_id, False), 0),
+            'votesYes': votes.get((card_id, True), 0),
+            'comments': comments.get((card_id, None), 0),
+            'attachments': attachments.get((card_id, None), 0),
+            'checkitems': checked + items.get((card_id, False), 0),
+            'checkitemsChecked': checked,
+        }, covers.get(card_id, ''))
+    return result
+
+
+class BoardRecords(object):
+    __slots__ = ('board', 'lists', 'cards', 'size', 'loaded')
+
+    def __init__(self, board, lists, cards):
+        self.board = board
+        # list id -> serialized list
+        self.lists = lists
+        # card id -> serialized card with badges and cover
+        self.cards = cards
+        self.size = _sizeof(board) + _sizeof(lists) + _sizeof(cards)
+        self.loaded = time.time()
+
+    def card(self, record):
+        return dict(record, board=self.board,
+                    list=self.lists.get(record['listId']))
+
+
+class HotBoards(object):
+
+    def __init__(self, budget=0, max_age=60):
+        self.budget = budget
+        self.max_age = max_age
+        # board id -> `BoardRecords`, least recently used first
+        self.boards = OrderedDict()
+        # list or card id -> board id
+        self.parents = {}
+        self.used = 0
+
+    def load(self, board_id):
+        """ load board unless it is loaded, mark it as recently used """
+        if self.budget and self.get(board_id) is None:
+            records = self._build(board_id)
+            if records is not None:
+                self._add(str(board_id), records)
+                self._evict()
+
+    def get(self, board_id):
+        """ records of a loaded board, rebuilt if older than `max_age`,
+        None unless it is loaded
+        """
+        board_id = str(board_id)
+        records = self.boards.get(board_id)
+        if records is None:
+            return None
+        if time.time() - records.loaded > self.max_age:
+            records = self._build(board_id)
+            if records is None:
+                self.evict(board_id)
+                return None
+            self._add(board_id, records)
+            self._evict()
+            return records
+        self.boards[board_id] = self.boards.pop(board_id)
+        return records
+
+    def evict(self, board_id):
+        records = self.boards.pop(str(board_id), None)
+        if records is None:
+            return
+        self.used -= records.size
+        for object_id in list(records.lists) + list(records.cards):
+            self.parents.pop(object_id, None)
+
+    def lists(self, board_id):
+        """ serialized lists of board, None unless it is loaded """
+        records = self.get(board_id)
+        return None if records is None else \
+            [dict(record) for record in records.lists.values()]
+
+    def cards(self, query):
+        """ serialized cards matching equality `query` on their fields, None
+        unless `query` has `listId`, `boardId` or `_id` of a loaded board
+        """
+        board_id = query.get('boardId') or \
+            self.parents.get(query.get('listId')) or \
+            self.parents.get(query.get('_id'))
+        records = self.get(board_id) if board_id else None
+        if records is None or any('__' in key or key.startswith('$')
+                                  for key in query):
+            return None
+        return [records.card(record) for record in records.cards.values()
+                if all(record.get(k) == v for k, v in query.items())]
+
+    def _build(self, board_id):
+        """ records of board, None if it no longer exists """
+        from documents import Board, Card, List
+
+        board = Board.objects(id=board_id).first()
+        if board is None:
+            return None
+        lists = OrderedDict((record['_id'], record) for record in
+                            List.objects(boardId=board_id).values())
+        cards = OrderedDict()
+        card_ids = []
+        for card in Card.objects(boardId=board_id):
+            card_ids.append(card.id)
+            cards[str(card.id)] = serialize(card.to_mongo())
+        for card_id, (badges, cover) in card_badges(card_ids).items():
+            cards[card_id].update(badges=badges, cover=cover)
+        return BoardRecords(board.to_dict(), lists, cards)
+
+    def _add(self, board_id, records):
+        self.evict(board_id)
+        self.boards[board_id] = records
+        self.used += records.size
+        for object_id in list(records.lists) + list(records.cards):
+            self.parents[object_id] = board_id
+
+    def _evict(self):
+        # the most recently used board stays even if it alone is too big
+        while self.used > self.budget and len(self.boards) > 1:
+            self.evict(next(iter(self.boards)))
+
+    def _set(self, records, kind, object_id, record):
+        """ replace record of list or card, None removes it """
+        old = getattr(records, kind).pop(object_id, None)
+        change = -_sizeof(old) if old is not None else 0
+        if record is not None:
+            getattr(records, kind)[object_id] = record
+            change += _sizeof(record)
+        records.size += change
+        self.used += change
+
+    def on_change(self, action, obj):
+        if not self.boards:
+            return
+        from documents import (Attachment, Board, Card, Checklist,
+                               ChecklistItem, Comment, List, Vote)
+
+        if action == 'cascade':
+            self.evict(obj['boardId'])
+        elif isinstance(obj, Board):
+            if action == 'delete':
+                self.evict(obj.id)
+            elif str(obj.id) in self.boards:
+                self.boards[str(obj.id)].board = obj.to_dict()
+        elif isinstance(obj, (List, Card)):
+            self._change(action, obj)
+        elif isinstance(obj, (Attachment, Checklist, ChecklistItem, Comment,
+                              Vote)):
+            # badges or cover of the card may have changed
+            card_id = ref_id(obj._data['cardId'])
+            records = self.boards.get(self.parents.get(str(card_id)))
+            if records is not None and str(card_id) in records.cards:
+                badges, cover = card_badges([card_id])[str(card_id)]
+                self._set(records, 'cards', str(card_id), dict(
+                    records.cards[str(card_id)], badges=badges, cover=cover))
+
+    def _change(self, action, obj):
+        kind = 'lists' if type(obj).__name__ == 'List' else 'cards'
+        object_id = str(obj.id)
+        board_id = str(ref_id(obj._data['boardId']))
+        old_board_id = self.parents.get(object_id)
+
+        if old_board_id is not None and (action == 'delete' or
+                                         old_board_id != board_id):
+            self._set(self.boards[old_board_id], kind, object_id, None)
+            del self.parents[object_id]
+        if action == 'delete' or board_id not in self.boards:
+            return
+
+        records = self.boards[board_id]
+        record = dict(getattr(records, kind).get(object_id) or
+                      ({'badges': dict(EMPTY_BADGES), 'cover': ''}
+                       if kind == 'cards' else {}))
+        record.update(serialize(obj.to_mongo()))
+        record['_id'] = object_id
+        self._set(records, kind, object_id, record)
+        self.parents[object_id] = board_id
+        self._evict()
+
+
+hot_boards = HotBoards()
+crud_hooks.append(hot_boards.on_change)
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+Coalescing of update and patch events.
+
+Fields updated by socket events are merged per document and written once
+`window` seconds after the last update of the document, or at most
+`max_delay` seconds after the first one, so a burst of edits is one
+`update_doc` and one emit instead of one per event. Changes of a
+`cascade_field` are written at once.
+
+Pending writes are flushed before reads which may return them, see
+`flush_read()`, when the document is deleted, when a connection which
+updated it closes and on shutdown. A `window` of 0 writes every update
+immediately.
+"""
+import logging
+import time
+from collections import OrderedDict
+
+from tornado import ioloop
+
+logger = logging.getLogger('cantas.writes')
+
+
+class PendingWrite(object):
+    """ merged fields of one document and connections which updated it """
+
+    def __init__(self, cls, object_id):
+        self.cls = cls
+        self.object_id = object_id
+        self.data = {}
+        self.conns = []
+        self.first = time.time()
+        self.timeout = None
+        # stored values of fields reads were filtered by, see `flush_read`
+        self.stored = {}
+
+    def matches(self, query):
+        """ whether the document may be returned by equality `query`,
+        before or after this write
+        """
+        return all(_id(value) in (_id(self.stored.get(field)),
+                                  _id(self.data.get(field)))
+                   for field, value in query.items())
+
+
+def _id(value):
+    """ id of a reference as sent by clients, the id or {'_id': id} """
+    return str(value.get('_id') if isinstance(value, dict) else value)
+
+
+class WriteBuffer(object):
+
+    def __init__(self, window=0.3, max_delay=2.0):
+        self.window = window
+        self.max_delay = max_delay
+        # (document class, id) -> `PendingWrite`
+        self.pending = OrderedDict()
+
+    def __len__(self):
+        return len(self.pending)
+
+    def add(self, cls, conn, object_id, data):
+        key = (cls, str(object_id))
+        write = self.pending.get(key)
+        if write is None:
+            write = self.pending[key] = PendingWrite(cls, object_id)
+        write.data.update(data)
+        if conn not in write.conns:
+            write.conns.append(conn)
+
+        if not self.window or cls.cascade_field in data:
+            self.flush(key)
+            return
+
+        io_loop = ioloop.IOLoop.current()
+        if write.timeout is not None:
+            io_loop.remove_timeout(write.timeout)
+        write.timeout = io_loop.add_timeout(
+            min(time.time() + self.window, write.first + self.max_delay),
+            lambda: self.flush(key))
+
+    def flush(self, key=None):
+        """ write pending fields of document `key`, or of all documents """
+        for key in [key] if key else list(self.pending):
+            write = self.pending.pop(key, None)
+            if write is None:
+                continue
+            if write.timeout is not None:
+                ioloop.IOLoop.current().remove_timeout(write.timeout)
+            try:
+                write.cls._write(write.conns, write.object_id, write.data)
+            except Exception:
+                logger.exception('writing %s %s failed', write.cls.__name__,
+                                 write.object_id)
+
+    def flush_document(self, cls, object_id):
+        self.flush((cls, str(object_id)))
+
+    def flush_read(self, cls, query):
+        """ write pending documents of `cls` which a read of `query` may
+        return: the document with `_id`, or documents matching the other
+        fields of the query, e.g. the cards of a list
+        """
+        query = query.get('$query', query)
+        if '_id' in query:
+            self.flush_document(cls, query['_id'])
+            return
+
+        writes = [(key, write) for key, write in self.pending.items()
+                  if key[0] is cls]
+        if not writes:
+            return
+        if any('__' in field or field.startswith('$') for field in query):
+            # not worth matching, write them all
+            for key, _ in writes:
+                self.flush(key)
+            return
+
+        query = dict((field, value) for field, value in query.items()
+                     if field in cls._fields)
+        missing = [write.object_id for _, write in writes
+                   if not set(query) <= set(write.stored)]
+        if missing:
+            for doc in cls.objects(id__in=missing).only(
+                    *query).as_pymongo():
+                write = self.pending[(cls, str(doc['_id']))]
+                write.stored.update((field, doc.get(field))
+                                    for field in query)
+        for key, write in writes:
+            if write.matches(query):
+                self.flush(key)
+
+    def flush_connection(self, conn):
+        for key, write in list(self.pending.items()):
+            if conn in write.conns:
+                self.flush(key)
+
+
+pending_writes = WriteBuffer()
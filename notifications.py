@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+Notifications of users, pushed to them when online.
+
+A crud hook notifies users @mentioned in a new comment, if they are members
+of the board, and the subscribers of the commented card.
+"""
+import re
+
+from models import (BoardMemberRelation, Card, Comment, Notification, User,
+                    crud_hooks, ref_id)
+from sock import Connection
+
+INFORMATION = Notification.notification_type['information']
+MENTIONED = Notification.notification_type['mentioned']
+SUBSCRIPTION = Notification.notification_type['subscription']
+
+_MENTION_RE = re.compile(r'@(\w+)', re.UNICODE)
+
+
+def notify_users(user_ids, message, type=INFORMATION):
+    """ store a notification for every user with one write and push it to
+    the users that are online
+
+        Example usage::
+
+            notify_users([user.id for user in users], 'card moved',
+                         Notification.notification_type['subscription'])
+
+    """
+    if not user_ids:
+        return []
+    notifications = Notification.notify(user_ids, message, type)
+    for notification in notifications:
+        Connection.emit_to_users([notification._data['userId']],
+                                 '/notification:create',
+                                 notification.to_dict())
+    return notifications
+
+
+def notify_board_members(board_id, message, type=INFORMATION, exclude=()):
+    """ notify all members of board, except users in `exclude` """
+    exclude = set(str(user_id) for user_id in exclude)
+    return notify_users(
+        [user_id for user_id in
+         BoardMemberRelation.get_board_member_ids(board_id)
+         if str(user_id) not in exclude],
+        message, type
+    )
+
+
+def on_comment(action, obj):
+    if action != 'create' or not isinstance(obj, Comment):
+        return
+    card = Card.objects(id=ref_id(obj._data['cardId'])).only(
+        'title', 'boardId', 'subscribeUserIds').as_pymongo().first()
+    if card is None:
+        return
+    author_id = ref_id(obj._data['authorId'])
+    author = User.objects(id=author_id).only(
+        'username').as_pymongo().first() or {}
+    link = '[%s](/card/%s)' % (card.get('title', ''), card['_id'])
+
+    mentioned = []
+    names = set(_MENTION_RE.findall(obj.content or u''))
+    if names:
+        members = set(str(user_id) for user_id in
+                      BoardMemberRelation.get_board_member_ids(
+                          card['boardId']))
+        mentioned = [user_id for user_id in
+                     User.objects(username__in=list(names)).scalar('id')
+                     if str(user_id) in members and user_id != author_id]
+        notify_users(mentioned, '%s mentioned you on %s' % (
+            author.get('username', ''), link), MENTIONED)
+
+    notified = set([author_id] + mentioned)
+    notify_users(
+        [user_id for user_id in card.get('subscribeUserIds', [])
+         if user_id not in notified],
+        '%s commented on %s' % (author.get('username', ''), link),
+        SUBSCRIPTION)
+
+
+crud_hooks.append(on_comment)
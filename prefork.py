@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""
+Pre-fork launch mode.
+
+The master process binds all sockets, forks `workers` worker processes and
+one sticky router, restarts children that die and drains them on SIGTERM or
+SIGINT. Workers listen on 127.0.0.1:`worker_port` + worker id, the router
+owns the public port and pipes every connection to a worker: socket.io
+transport requests go to the worker whose id prefixes the session id (see
+`sock.Router`), all other requests, the handshake included, go to the
+workers in turn. The router reads the head of the request only, so it asks
+the worker to close the connection after the response with
+`Connection: close` and the client's next request is routed again, except
+for websocket upgrades, which stay on their worker. The client address is
+passed in `X-Forwarded-For`, workers run with `xheaders`.
+
+The master never runs an IOLoop and does not touch the database, so every
+child starts with a fresh IOLoop and sets up its own mongo connection.
+
+Workers share nothing but the database. State kept in process is only
+about the worker's own clients and writes: `Connection.online`, so
+`notifications.notify_users` reaches only users connected to the same
+worker, board `presence`, `hot_boards` and Trello import progress in
+`trello.jobs`. There is no fan-out between workers, the `search.index`
+of a worker catches up with the others' writes by polling.
+"""
+import errno
+import logging
+import os
+import re
+import signal
+import socket
+import time
+
+from tornado import gen, ioloop, netutil, process
+from tornado.iostream import IOStream, StreamClosedError
+from tornado.tcpserver import TCPServer
+
+logger = logging.getLogger('cantas.prefork')
+
+ROUTER = -1
+
+_SESSION_RE = re.compile(br'^\S+ /socket\.io/1/[\w-]+/(\d+)_')
+_HEAD_END_RE = br'\r?\n\r?\n'
+MAX_HEAD_BYTES = 65536
+
+
+def rewrite_head(head, address):
+    """ add `address` to X-Forwarded-For of a request head and, unless it is
+    a websocket upgrade, make the worker close the connection afterwards
+    """
+    lines = [line.rstrip(b'\r') for line in head.split(b'\n')]
+    lines = [line for line in lines if line]
+    headers = [(line.partition(b':')[0].strip().lower(), line)
+               for line in lines[1:]]
+    upgrade = any(name == b'upgrade' for name, line in headers)
+    forwarded_for = []
+    result = [lines[0]]
+    for name, line in headers:
+        if name == b'x-forwarded-for':
+            forwarded_for.append(line.partition(b':')[2].strip())
+        elif upgrade or name not in (b'connection', b'keep-alive'):
+            result.append(line)
+    forwarded_for.append(address.encode())
+    result.append(b'X-Forwarded-For: ' + b', '.join(forwarded_for))
+    if not upgrade:
+        result.append(b'Connection: close')
+    return b'\r\n'.join(result) + b'\r\n\r\n'
+
+
+class StickyRouter(TCPServer):
+    """ pipe connections to workers, keeping socket.io sessions sticky """
+
+    def __init__(self, worker_ports, **kwargs):
+        super(StickyRouter, self).__init__(**kwargs)
+        self.worker_ports = worker_ports
+        self.streams = set()
+        self.next_index = 0
+
+    def route(self, request_line):
+        match = _SESSION_RE.match(request_line)
+        if match:
+            index = int(match.group(1))
+        else:
+            index = self.next_index
+            self.next_index = (index + 1) % len(self.worker_ports)
+        return self.worker_ports[index % len(self.worker_ports)]
+
+    @gen.coroutine
+    def handle_stream(self, stream, address):
+        self.streams.add(stream)
+        upstream = None
+        try:
+            head = yield stream.read_until_regex(
+                _HEAD_END_RE, max_bytes=MAX_HEAD_BYTES)
+            upstream = IOStream(socket.socket())
+            self.streams.add(upstream)
+            yield upstream.connect(('127.0.0.1', self.route(head)))
+            yield upstream.write(rewrite_head(head, address[0]))
+            yield [self._pipe(stream, upstream), self._pipe(upstream, stream)]
+        except (StreamClosedError, socket.error):
+            pass
+        finally:
+            for s in (stream, upstream):
+                if s is not None:
+                    s.close()
+                    self.streams.discard(s)
+
+    @gen.coroutine
+    def _pipe(self, source, destination):
+        try:
+            while True:
+                data = yield source.read_bytes(65536, partial=True)
+                yield destination.write(data)
+        except StreamClosedError:
+            destination.close()
+
+
+def drain_on_signal(server, is_idle, timeout, callbacks=()):
+    """ on SIGTERM/SIGINT stop accepting connections, run `callbacks` and
+    stop the IOLoop once `is_idle()` or after `timeout` seconds
+    """
+    io_loop = ioloop.IOLoop.current()
+
+    def drain():
+        logger.info('process %d draining', os.getpid())
+        server.stop()
+        for callback in callbacks:
+            callback()
+
+        deadline = time.time() + timeout
+
+        def check():
+            if is_idle() or time.time() > deadline:
+                io_loop.stop()
+            else:
+                io_loop.add_timeout(time.time() + 0.5, check)
+        check()
+
+    def handler(signum, frame):
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        io_loop.add_callback_from_signal(drain)
+
+    signal.signal(signal.SIGTERM, handler)
+    signal.signal(signal.SIGINT, handler)
+
+
+def run(start_worker, port, address='', workers=0, worker_port=None,
+        drain_timeout=10):
+    """ run `start_worker(sockets, worker_id)` in pre-forked processes
+
+    `workers` defaults to number of cpus, `worker_port` to `port` + 1
+    """
+    workers = workers or process.cpu_count()
+    worker_port = worker_port or port + 1
+    public_sockets = netutil.bind_sockets(port, address)
+    worker_sockets = [netutil.bind_sockets(worker_port + i, '127.0.0.1')
+                      for i in range(workers)]
+
+    children = {}
+    stopping = []
+
+    def spawn(task_id):
+        pid = os.fork()
+        if pid:
+            children[pid] = task_id
+            return
+
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        for i, sockets in enumerate(worker_sockets):
+            if i != task_id:
+                for s in sockets:
+                    s.close()
+
+        if task_id == ROUTER:
+            router = StickyRouter([worker_port + i for i in range(workers)])
+            router.add_sockets(public_sockets)
+            drain_on_signal(router, lambda: not router.streams, drain_timeout)
+            ioloop.IOLoop.current().start()
+        else:
+            for s in public_sockets:
+                s.close()
+            start_worker(worker_sockets[task_id], task_id)
+        os._exit(0)
+
+    def stop(signum, frame):
+        if not stopping:
+            stopping.append(time.time() + drain_timeout + 5)
+            for pid in children:
+                os.kill(pid, signal.SIGTERM)
+
+    for task_id in [ROUTER] + list(range(workers)):
+        spawn(task_id)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    while children:
+        if stopping and time.time() > stopping[0]:
+            for pid in children:
+                os.kill(pid, signal.SIGKILL)
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                continue
+            raise
+        if not pid:
+            time.sleep(0.2)
+            continue
+
+        task_id = children.pop(pid)
+        if not stopping:
+            logger.warning('child %d (task %d) exited with status %d, '
+                           'restarting', pid, task_id, status)
+            time.sleep(1)
+            spawn(task_id)
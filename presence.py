@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+Who is looking at which board.
+
+A connection joins one board at a time and stays present until it leaves,
+joins another board, closes or stops sending heartbeats for `timeout`
+seconds. Expiry runs on a `TimingWheel`, a tick only looks at the
+connections expiring in it. Only changes are broadcast to the board:
+'user-login:board:<id>' when a user's first connection joins and
+'user-logout:board:<id>' when their last one leaves, the full list of
+visitors is sent to the joining connection only.
+
+Like the search index presence is per process, in pre-fork mode a board's
+visitors are those connected to the same worker.
+"""
+from collections import defaultdict
+
+from tornado import ioloop
+
+ROLES = {
+    'admin': 'Admin - full control',
+    'member': 'Member - edit board',
+    'viewer': 'Viewer - read only',
+}
+
+
+class TimingWheel(object):
+    """ expire keys `timeout` seconds after they were last touched
+
+    Keys live in one of `timeout / tick` slots, touching moves a key to the
+    slot expiring last and every `tick()` empties the next slot, so both
+    are O(1) per key regardless of the number of keys.
+    """
+
+    def __init__(self, timeout, tick=1.0):
+        self.slots = [set() for _ in range(int(timeout / tick) + 1)]
+        self.position = 0
+        # key -> index of its slot
+        self.slot_of = {}
+
+    def __len__(self):
+        return len(self.slot_of)
+
+    def touch(self, key):
+        self.discard(key)
+        slot = (self.position - 1) % len(self.slots)
+        self.slots[slot].add(key)
+        self.slot_of[key] = slot
+
+    def discard(self, key):
+        slot = self.slot_of.pop(key, None)
+        if slot is not None:
+            self.slots[slot].discard(key)
+
+    def tick(self):
+        """ advance one slot, return keys expired in it """
+        self.position = (self.position + 1) % len(self.slots)
+        expired = self.slots[self.position]
+        self.slots[self.position] = set()
+        for key in expired:
+            del self.slot_of[key]
+        return expired
+
+
+class BoardPresence(object):
+    """ board id -> present users and their connections """
+
+    def __init__(self, timeout=60, tick=1.0):
+        self.tick_interval = tick
+        self.wheel = TimingWheel(timeout, tick)
+        # board id -> {user id: (visitor, set of connections)}, the board
+        # a connection is on is `conn.user.board_id`
+        self.boards = defaultdict(dict)
+
+    def start(self):
+        ioloop.PeriodicCallback(self.tick,
+                                self.tick_interval * 1000).start()
+
+    def visitors(self, board_id):
+        return [visitor for visitor, _ in self.boards.get(board_id,
+                                                          {}).values()]
+
+    def join(self, conn, board_id, role):
+        """ put `conn` on board, `role` is 'admin', 'member' or 'viewer' """
+        board_id = str(board_id)
+        if conn.user.board_id != board_id:
+            self.leave(conn)
+
+        conn.user.board_id = board_id
+        self.wheel.touch(conn)
+        users = self.boards[board_id]
+        if conn.user._id in users:
+            users[conn.user._id][1].add(conn)
+            return
+
+        visitor = {'_id': conn.user._id, 'username': conn.user.username,
+                   'email': conn.user.email,
+                   'role': {'name': role, 'desc': ROLES[role]}}
+        users[conn.user._id] = (visitor, set([conn]))
+        self._broadcast(board_id, 'user-login', visitor, conn)
+
+    def heartbeat(self, conn):
+        if conn.user.board_id is not None:
+            self.wheel.touch(conn)
+
+    def leave(self, conn):
+        self.wheel.discard(conn)
+        board_id, conn.user.board_id = conn.user.board_id, None
+        users = self.boards.get(board_id)
+        if users is None or conn.user._id not in users:
+            return
+
+        visitor, connections = users[conn.user._id]
+        connections.discard(conn)
+        if connections:
+            return
+        del users[conn.user._id]
+        if not users:
+            del self.boards[board_id]
+        self._broadcast(board_id, 'user-logout', visitor)
+
+    def tick(self):
+        for conn in self.wheel.tick():
+            self.leave(conn)
+
+    def _broadcast(self, board_id, event, visitor, exclude=None):
+        name = '%s:board:%s' % (event, board_id)
+        for _, connections in self.boards.get(board_id, {}).values():
+            for conn in connections:
+                if conn is not exclude:
+                    conn.emit(name, {'visitor': visitor})
+
+
+presence = BoardPresence()
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+Per request/event accounting of mongo commands.
+
+`start()` begins accounting of a http request or socket event, `finish()`
+logs number of commands and database time of it, and warns about slow
+requests and repeated commands of the same shape, which usually is an N+1
+query. With `--query_bytes` bytes sent and received are logged too, which
+encodes every command again. A sample of requests can be run under
+cProfile, the profile is dumped to `--profile_dir` if the request is slow.
+
+Commands are counted with pymongo command monitoring (pymongo >= 3.1),
+the listener must be registered before the first connection is created,
+so import this module before `models`. Queries of coroutines interleaving
+on the IOLoop are attributed to the most recently started request which is
+still running, queries of other threads, e.g. maintenance jobs, to none.
+"""
+import cProfile
+import logging
+import os
+import random
+import threading
+import time
+from collections import defaultdict
+
+from bson import BSON
+from tornado.options import define, options
+
+try:
+    from pymongo import monitoring
+except ImportError:
+    monitoring = None
+
+define("slow_request_ms", default=500, type=int,
+       help="log requests and socket events slower than this")
+define("query_log_threshold", default=50, type=int,
+       help="log requests and socket events issuing more queries")
+define("n_plus_one_threshold", default=10, type=int,
+       help="log queries of the same shape repeated more in one request")
+define("profile_sample_rate", default=0.0, type=float,
+       help="fraction of requests run under cProfile")
+define("profile_dir", default="/tmp/cantas-profiles",
+       help="where profiles of slow sampled requests are dumped")
+define("query_bytes", default=False, type=bool,
+       help="account bytes of commands and replies, costs encoding them")
+
+logger = logging.getLogger('cantas.queries')
+
+# requests and events being accounted, in the order they started
+_active = []
+
+
+class QueryStats(object):
+    """ mongo commands issued while handling one request or event """
+
+    def __init__(self, name):
+        self.name = name
+        self.queries = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.db_time = 0.0
+        self.shapes = defaultdict(int)
+        self.started = time.time()
+        self.profiler = None
+        self.thread = threading.current_thread().ident
+
+    def command_started(self, event):
+        self.queries += 1
+        if options.query_bytes:
+            self.bytes_sent += len(BSON.encode(event.command))
+        self.shapes[_command_shape(event.command_name, event.command)] += 1
+
+    def command_finished(self, event, reply=None):
+        self.db_time += event.duration_micros / 1e6
+        if reply is not None and options.query_bytes:
+            self.bytes_received += len(BSON.encode(reply))
+
+    def repeated(self):
+        return {shape: count for shape, count in self.shapes.items()
+                if count > options.n_plus_one_threshold}
+
+    def summary(self, elapsed):
+        summary = '%s: %.1fms, %d queries, %.1fms in db' % (
+            self.name, elapsed * 1000, self.queries, self.db_time * 1000)
+        if options.query_bytes:
+            summary += ', %d/%d bytes' % (self.bytes_sent,
+                                          self.bytes_received)
+        return summary
+
+
+def _shape(value):
+    """ replace values of a query with their type names """
+    if isinstance(value, dict):
+        return '{%s}' % ', '.join('%s: %s' % (k, _shape(v))
+                                  for k, v in sorted(value.items()))
+    if isinstance(value, (list, tuple)):
+        return '[%s]' % (_shape(value[0]) if value else '')
+    return type(value).__name__
+
+
+def _command_shape(name, command):
+    query = command.get('filter', command.get('query'))
+    if query is None and command.get('updates'):
+        query = command['updates'][0].get('q')
+    if query is None and command.get('deletes'):
+        query = command['deletes'][0].get('q')
+    return '%s %s %s' % (name, command.get(name), _shape(query or {}))
+
+
+def _current():
+    """ stats commands of the calling thread are credited to, if any """
+    if _active and _active[-1].thread == threading.current_thread().ident:
+        return _active[-1]
+    return None
+
+
+if monitoring is not None:
+    class _CommandListener(monitoring.CommandListener):
+        def started(self, event):
+            stats = _current()
+            if stats is not None:
+                stats.command_started(event)
+
+        def succeeded(self, event):
+            stats = _current()
+            if stats is not None:
+                stats.command_finished(event, event.reply)
+
+        def failed(self, event):
+            stats = _current()
+            if stats is not None:
+                stats.command_finished(event)
+
+    monitoring.register(_CommandListener())
+
+
+def start(name):
+    """ start accounting of request or event `name` """
+    stats = QueryStats(name)
+    if options.profile_sample_rate and not _active and \
+            random.random() < options.profile_sample_rate:
+        stats.profiler = cProfile.Profile()
+        stats.profiler.enable()
+    _active.append(stats)
+    return stats
+
+
+def finish(stats):
+    """ stop accounting of `stats` and log it if it looks suspicious """
+    elapsed = time.time() - stats.started
+    if stats in _active:
+        _active.remove(stats)
+
+    slow = elapsed * 1000 > options.slow_request_ms
+    if stats.profiler is not None:
+        stats.profiler.disable()
+        if slow:
+            _dump_profile(stats)
+
+    repeated = stats.repeated()
+    if slow or repeated or stats.queries > options.query_log_threshold:
+        logger.warning(stats.summary(elapsed))
+        for shape, count in repeated.items():
+            logger.warning('%s: possible N+1, %d x %s', stats.name, count,
+                           shape)
+    else:
+        logger.debug(stats.summary(elapsed))
+
+
+def _dump_profile(stats):
+    try:
+        os.makedirs(options.profile_dir)
+    except OSError:
+        pass
+
+    path = os.path.join(options.profile_dir, '%s-%d.prof' % (
+        ''.join(c if c.isalnum() else '_' for c in stats.name)[:80],
+        stats.started * 1000))
+    stats.profiler.dump_stats(path)
+    logger.warning('%s: profile dumped to %s', stats.name, path)
@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+"""
+In-process full text search over cards and comments.
+
+Every board has an inverted index of the tokens of its unarchived cards'
+title and description and of their comments, a comment matches the card it
+belongs to. `index.rebuild()` builds it in bulk on startup and a crud hook
+keeps it up to date on socket events handled by this process, a cascade
+reindexes just the cards under its board or list. Cards and comments
+written by other processes, the sync scheduler and imports are picked up
+by `index.refresh()` from their update times. Cards found deleted or
+archived when results are fetched are dropped from the index, comments
+deleted by other processes stay until the next rebuild.
+"""
+import heapq
+import math
+import re
+from collections import defaultdict, Counter
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+
+from models import Card, Comment, card_badges, crud_hooks, ref_id, serialize
+
+# fields of cards in search results, besides badges, cover and score
+RESULT_FIELDS = ('title', 'description', 'listId', 'boardId', 'dueDate',
+                 'assignees', 'order')
+
+# CJK characters are tokens on their own, other words are runs of letters
+_TOKEN_RE = re.compile(u'[\u3400-\u9fff]|[^\\W_\u3400-\u9fff]+',
+                       re.UNICODE)
+
+# most results a single search returns
+max_limit = 100
+
+
+def tokenize(text):
+    return _TOKEN_RE.findall((text or u'').lower())
+
+
+def paging(offset, limit):
+    """ `offset` and `limit` of a search as integers, clamped to 0.. and
+    1..`max_limit`, raises ValueError or TypeError if they are not numbers
+    """
+    return max(int(offset), 0), min(max(int(limit), 1), max_limit)
+
+
+class BoardIndex(object):
+    """ inverted index of one board: token -> {card id: term frequency} """
+
+    def __init__(self):
+        self.postings = defaultdict(Counter)
+        # card id -> {(kind, id) of indexed doc: tokens of doc}
+        self.cards = defaultdict(dict)
+
+    def add(self, card_id, key, tokens):
+        self.remove(card_id, key)
+        self.cards[card_id][key] = tokens
+        for token, count in tokens.items():
+            self.postings[token][card_id] += count
+
+    def remove(self, card_id, key):
+        tokens = self.cards.get(card_id, {}).pop(key, None)
+        if tokens is None:
+            return
+        for token, count in tokens.items():
+            posting = self.postings[token]
+            posting[card_id] -= count
+            if posting[card_id] <= 0:
+                del posting[card_id]
+            if not posting:
+                del self.postings[token]
+        if not self.cards[card_id]:
+            del self.cards[card_id]
+
+    def remove_card(self, card_id):
+        for key in list(self.cards.get(card_id, ())):
+            self.remove(card_id, key)
+
+    def search(self, tokens):
+        """ return {card id: score} of cards matching all `tokens` """
+        postings = [self.postings.get(token) for token in set(tokens)]
+        if not postings or not all(postings):
+            return {}
+
+        postings.sort(key=len)
+        matches = set(postings[0])
+        for posting in postings[1:]:
+            matches.intersection_update(posting)
+
+        total = float(len(self.cards))
+        scores = dict.fromkeys(matches, 0.0)
+        for posting in postings:
+            idf = math.log(1 + total / len(posting))
+            for card_id in matches:
+                scores[card_id] += (1 + math.log(posting[card_id])) * idf
+        return scores
+
+
+class SearchIndex(object):
+    """ board id -> `BoardIndex` of the board """
+    # seconds a refresh looks back before the previous one, for writes
+    # committed late or by hosts with a clock slightly behind
+    refresh_overlap = 10
+
+    def __init__(self):
+        self.boards = defaultdict(BoardIndex)
+        # card id -> board id, to find the board of a comment
+        self.card_boards = {}
+        self.refreshed = None
+
+    def add_card(self, card_id, board_id, title, description):
+        card_id, board_id = str(card_id), str(board_id)
+        if self.card_boards.get(card_id, board_id) != board_id:
+            self.remove_card(card_id)
+        self.card_boards[card_id] = board_id
+        self.boards[board_id].add(card_id, ('card', card_id),
+                                  Counter(tokenize(title) +
+                                          tokenize(description)))
+
+    def remove_card(self, card_id):
+        board_id = self.card_boards.pop(str(card_id), None)
+        if board_id is not None:
+            self.boards[board_id].remove_card(str(card_id))
+
+    def update_card(self, card_id, board_id, title, description):
+        """ `add_card` which also indexes the comments of a card that was
+        not indexed on the board, e.g. because it was archived or moved
+        """
+        reindex_comments = self.card_boards.get(str(card_id)) != \
+            str(board_id)
+        self.add_card(card_id, board_id, title, description)
+        if reindex_comments:
+            for comment in Comment.objects(cardId=card_id).only(
+                    'content').as_pymongo():
+                self.add_comment(comment['_id'], card_id,
+                                 comment.get('content'))
+
+    def add_comment(self, comment_id, card_id, content):
+        board_id = self.card_boards.get(str(card_id))
+        if board_id is not None:
+            self.boards[board_id].add(str(card_id),
+                                      ('comment', str(comment_id)),
+                                      Counter(tokenize(content)))
+
+    def remove_comment(self, comment_id, card_id):
+        board_id = self.card_boards.get(str(card_id))
+        if board_id is not None:
+            self.boards[board_id].remove(str(card_id),
+                                         ('comment', str(comment_id)))
+
+    def rebuild(self, board_id=None):
+        """ rebuild index of `board_id` or of all boards """
+        cards = Card.objects(isArchived=False)
+        comments = Comment.objects
+        if board_id is None:
+            self.boards.clear()
+            self.card_boards.clear()
+            self.refreshed = datetime.now()
+        else:
+            self.remove_board(board_id)
+            cards = cards.filter(boardId=board_id)
+            comments = comments.filter(cardId__in=list(
+                Card.objects(boardId=board_id).scalar('id')))
+
+        for card in cards.only('boardId', 'title',
+                               'description').as_pymongo():
+            self.add_card(card['_id'], card['boardId'], card.get('title'),
+                          card.get('description'))
+        for comment in comments.only('cardId', 'content').as_pymongo():
+            self.add_comment(comment['_id'], comment['cardId'],
+                             comment.get('content'))
+
+    def remove_board(self, board_id):
+        for card_id in self.boards.pop(str(board_id), BoardIndex()).cards:
+            self.card_boards.pop(card_id, None)
+
+    def reindex(self, root, root_id):
+        """ index cards under board or list `root` again after a cascade,
+        cards of a deleted list are dropped once search finds them deleted
+        """
+        field = 'listId' if root == 'list' else 'boardId'
+        added = []
+        for card in Card.objects(**{field: root_id}).only(
+                'boardId', 'title', 'description',
+                'isArchived').as_pymongo():
+            if card.get('isArchived'):
+                self.remove_card(card['_id'])
+                continue
+            if str(card['_id']) not in self.card_boards:
+                added.append(card['_id'])
+            self.add_card(card['_id'], card['boardId'], card.get('title'),
+                          card.get('description'))
+        # comments of restored cards, in one query instead of one per card
+        if added:
+            for comment in Comment.objects(cardId__in=added).only(
+                    'cardId', 'content').as_pymongo():
+                self.add_comment(comment['_id'], comment['cardId'],
+                                 comment.get('content'))
+
+    def refresh(self):
+        """ index cards and comments updated since the previous refresh """
+        started = datetime.now()
+        if self.refreshed is None:
+            self.rebuild()
+            return
+        since = self.refreshed - timedelta(seconds=self.refresh_overlap)
+
+        for card in Card.objects(updated__gte=since).only(
+                'boardId', 'title', 'description',
+                'isArchived').as_pymongo():
+            if card.get('isArchived'):
+                self.remove_card(card['_id'])
+            else:
+                self.update_card(card['_id'], card['boardId'],
+                                 card.get('title'), card.get('description'))
+        for comment in Comment.objects(updatedOn__gte=since).only(
+                'cardId', 'content').as_pymongo():
+            self.add_comment(comment['_id'], comment['cardId'],
+                             comment.get('content'))
+        self.refreshed = started
+
+    def search(self, board_id, query, offset=0, limit=20):
+        """ return {'total': n, 'cards': [..]} with cards of board matching
+        all words of `query`, best first
+        """
+        scores = self.boards[str(board_id)].search(tokenize(query)) \
+            if str(board_id) in self.boards else {}
+        ranked = heapq.nlargest(offset + limit, scores.items(),
+                                key=lambda item: item[1])[offset:]
+
+        cards = dict(
+            (str(card['_id']), serialize(card)) for card in
+            Card.objects(id__in=[i for i, _ in ranked], isArchived=False)
+            .only(*RESULT_FIELDS).as_pymongo())
+        badges = card_badges([ObjectId(card_id) for card_id in cards])
+        results = []
+        for card_id, score in ranked:
+            if card_id not in cards:
+                # deleted or archived by another process
+                self.remove_card(card_id)
+                continue
+            card = cards[card_id]
+            card['badges'], card['cover'] = badges[card_id]
+            card['score'] = score
+            results.append(card)
+        return {'total': len(scores), 'cards': results}
+
+    def on_change(self, action, obj):
+        if action == 'cascade':
+            if obj['root'] == 'board' and obj['action'] == 'delete':
+                self.remove_board(obj['_id'])
+            else:
+                self.reindex(obj['root'], obj['_id'])
+        elif isinstance(obj, Card):
+            if action == 'delete' or obj.isArchived:
+                self.remove_card(obj.id)
+            elif action == 'create':
+                self.add_card(obj.id, ref_id(obj._data['boardId']),
+                              obj.title, obj.description)
+            else:
+                self.update_card(obj.id, ref_id(obj._data['boardId']),
+                                 obj.title, obj.description)
+        elif isinstance(obj, Comment):
+            card_id = ref_id(obj._data['cardId'])
+            if action == 'delete':
+                self.remove_comment(obj.id, card_id)
+            else:
+                self.add_comment(obj.id, card_id, obj.content)
+
+
+index = SearchIndex()
+crud_hooks.append(index.on_change)
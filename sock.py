@@ -1,35 +1,144 @@
 # -*- coding: utf8 -*-
+from collections import defaultdict
 
 import tornadio2
+from tornadio2 import session
+from tornadio2.router import TornadioRouter
 
-from models import crud_event_handlers, User
+import profiling
+import search
+from models import (crud_event_handlers, get_permissions, hot_boards,
+                    pending_writes, Board, Notification, User)
+from presence import presence
+
+
+class SessionUser(object):
+    """ what a connection keeps of its user, much smaller than a `User` """
+    __slots__ = ('id', 'username', 'email', 'board_id')
+
+    def __init__(self, id, username, email):
+        self.id = id
+        self.username = username
+        self.email = email
+        # board joined by the connection, see `presence`
+        self.board_id = None
+
+    @property
+    def _id(self):
+        return str(self.id)
 
 
 class Connection(tornadio2.SocketConnection):
+    # user id -> open connections of the user, used to push events to users
+    online = defaultdict(set)
+
     def on_open(self, request):
         user_id = request.get_cookie('oid').value
-        setattr(self, 'user', User.objects.get(id=user_id))
+        user = User.objects(id=user_id).only(
+            'username', 'email').as_pymongo().first()
+        if user is None:
+            return False
+        setattr(self, 'user', SessionUser(user['_id'], user.get('username'),
+                                          user.get('email')))
+        setattr(self, 'permissions', get_permissions(user_id))
+        self.online[self.user._id].add(self)
+
+    def on_close(self):
+        if not hasattr(self, 'user'):
+            return
+        presence.leave(self)
+        pending_writes.flush_connection(self)
+        connections = self.online.get(self.user._id, set())
+        connections.discard(self)
+        if not connections:
+            self.online.pop(self.user._id, None)
+
+    @classmethod
+    def emit_to_users(cls, user_ids, name, *args, **kwargs):
+        for user_id in user_ids:
+            for conn in cls.online.get(str(user_id), ()):
+                conn.emit(name, *args, **kwargs)
 
     def on_event(self, name, args=[], kwargs=dict()):
-        if name in crud_event_handlers:
-            result = crud_event_handlers[name](self, *args, **kwargs)
-            if isinstance(result, tuple):
-                return result
+        stats = profiling.start(name)
+        presence.heartbeat(self)
+        try:
+            if name in crud_event_handlers:
+                handler = crud_event_handlers[name]
+                if name.endswith(':read'):
+                    # reads see coalesced updates of every client
+                    pending_writes.flush_read(handler.__self__, kwargs)
+                result = handler(self, *args, **kwargs)
+                if isinstance(result, tuple):
+                    return result
+                else:
+                    return None, result
             else:
-                return None, result
-        else:
-            return super(Connection, self).on_event(name, args, kwargs)
+                return super(Connection, self).on_event(name, args, kwargs)
+        finally:
+            profiling.finish(stats)
+
+    @tornadio2.event('card:search')
+    def on_card_search(self, boardId, query, offset=0, limit=20):
+        try:
+            offset, limit = search.paging(offset, limit)
+        except (TypeError, ValueError):
+            return 'Invalid offset or limit', None
+        if not self.permissions.can_read(boardId):
+            return 'Can not search board', None
+        return None, search.index.search(boardId, query, offset, limit)
+
+    @tornadio2.event('notification:mark-all-read')
+    def on_mark_all_read(self):
+        # single notifications marked read may still be coalescing
+        pending_writes.flush_connection(self)
+        Notification.mark_all_read(self.user.id)
 
-    # FIXME: it's fake
     @tornadio2.event('join-board')
-    def on_join_board(self, *args, **kwargs):
-
-        self.emit('joined-board',
-                  *[{"ok": 0, "visitors":
-                      [{"username": "admin", "email": "admin@admin.com",
-                        "_id": self.user._id, "__v": 0,
-                        "isFirstLogin": False, "roles": [],
-                        "joined": "2014-06-14T11:46:48.575Z", "fullname": "",
-                        "role": {"name": "admin",
-                                 "desc": "Admin - full control"}}],
-                     "message": "isMember"}])
+    def on_join_board(self, boardId):
+        board = Board.objects(id=boardId).only(
+            'isClosed', 'isPublic').as_pymongo().first()
+        role = self.permissions.role(boardId)
+        if board is None or board.get('isClosed'):
+            self.emit('joined-board', {'ok': 1, 'message': 'closed'})
+            return
+        if role not in ('admin', 'member') and \
+                not board.get('isPublic', True):
+            self.emit('joined-board', {'ok': 1, 'message': 'nologin'})
+            return
+
+        hot_boards.load(boardId)
+        presence.join(self, boardId, role if role in ('admin', 'member')
+                      else 'viewer')
+        self.emit('joined-board', {
+            'ok': 0, 'visitors': presence.visitors(boardId),
+            'message': 'isMember' if role in ('admin', 'member')
+            else 'notMember'})
+
+    @tornadio2.event('user-logout')
+    def on_leave_board(self, boardId=None, **kwargs):
+        # the client may have joined the next board already
+        if self.user.board_id == boardId:
+            presence.leave(self)
+
+    @tornadio2.event('board:heartbeat')
+    def on_board_heartbeat(self):
+        # every event is a heartbeat, see `on_event`
+        pass
+
+
+class Router(TornadioRouter):
+    """ tornadio2 router prefixing session ids with `worker_id`, the sticky
+    router of pre-fork mode sends transport requests to the session's worker
+    """
+    def __init__(self, connection, worker_id=None, **kwargs):
+        super(Router, self).__init__(connection, **kwargs)
+        self.worker_id = worker_id
+
+    def create_session(self, request):
+        sess = session.Session(self._connection, self, request,
+                               self.settings.get('session_expiry'))
+        if self.worker_id is not None:
+            sess.session_id = '%d_%s' % (self.worker_id, sess.session_id)
+        self._sessions.add(sess)
+        return sess
@@ -21,6 +21,7 @@
       if (!this.noIoBind) {
         this.ioBind('update', this.serverChange, this);
         this.ioBind('delete', this.serverDelete, this);
+        this.ioBind('cascade', this.serverCascade, this);
       }
     },
 
@@ -67,6 +68,19 @@
       }
     },
 
+    /*
+     * Lists and cards of this board were archived or restored in bulk,
+     * fetch them and merge the changes if they are shown.
+     */
+    serverCascade: function (data) {
+      if (data && data.action !== 'delete' && this.listCollection.length) {
+        this.listCollection.fetch({data: {boardId: this.id}});
+        this.listCollection.each(function (list) {
+          list.serverCascade(data);
+        });
+      }
+    },
+
     modelCleanup: function () {
       this.ioUnbindAll();
       return this;
@@ -15,6 +15,7 @@
       if (!this.noIoBind) {
         this.ioBind('update', this.serverChange, this);
         this.ioBind('delete', this.serverDelete, this);
+        this.ioBind('cascade', this.serverCascade, this);
       }
 
       // Attach card collections
@@ -59,6 +60,16 @@
       }
     },
 
+    /*
+     * Cards of this list were archived, restored or deleted in bulk, the
+     * summary carries only counts, so fetch them and merge the changes.
+     */
+    serverCascade: function (data) {
+      if (data && data.action !== 'delete') {
+        this.cardCollection.fetch({data: {listId: this.id}});
+      }
+    },
+
     modelCleanup: function () {
       this.ioUnbindAll();
       return this;
@@ -38,6 +38,7 @@ $(function ($, _, Backbone) {
         //logout the board
         var leaveBoardId = this.currentView.model.id;
         sock.emit('user-logout', {boardId: leaveBoardId, user: cantas.utils.getCurrentUser()});
+        clearInterval(this.presenceTimer);
       }
 
       this.currentView = view;
@@ -47,6 +48,10 @@ $(function ($, _, Backbone) {
       if (view && view.boardTitleView) {
         var joinBoardId = view.model.id;
         sock.emit('join-board', joinBoardId);
+        // keep presence on the board alive, it expires after a minute
+        this.presenceTimer = setInterval(function() {
+          sock.emit('board:heartbeat');
+        }, 20000);
       }
     },
 
@@ -111,8 +111,9 @@
       event.stopPropagation();
 
       this.notificationCollection.forEach(function(notify) {
-        notify.patch({isUnread: false});
+        notify.set({isUnread: false});
       });
+      cantas.socket.emit('notification:mark-all-read');
       this.pageBegin = 0;
       this._updateReminder();
       this.$('ul.js-dropdown-content li.unread').removeClass('unread');
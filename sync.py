@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+"""
+Periodic sync of cards and comments from the sources of `SyncConfig`s.
+
+`SyncScheduler` runs every active config each `intervalTime` minutes, give
+or take `jitter`, with at most `concurrency` fetches in flight over one
+pooled http client. A config's `queryUrl` is fetched with `since` set to
+its `lastSyncTime`, the response is parsed by the parser of its
+`queryType` and items are upserted in bulk: existing cards and comments are
+found by `sourceId` through the indexed source relations. Crud hooks run
+for every created or updated card, synced comments reach the search index
+by its refresh. Configs of a `queryType` without a parser are skipped and
+`lastSyncTime` only advances once a response was parsed.
+
+A source of queryType 'json' returns a list of (or {"items": [..]} with)
+items like::
+
+    {"id": "1234", "title": "...", "description": "...",
+     "comments": [{"id": "1", "text": "..."}]}
+"""
+import logging
+import random
+import time
+from collections import deque
+from datetime import datetime
+
+from bson import ObjectId
+from pymongo import UpdateOne
+from tornado import escape, gen, ioloop
+from tornado.httpclient import AsyncHTTPClient
+from tornado.httputil import url_concat
+
+from models import (Card, CardSourceRelation, Comment, CommentSourceRelation,
+                    List, SyncConfig)
+from models import SockCRUDMixin, ref_id
+
+logger = logging.getLogger('cantas.sync')
+
+
+def parse_json(body):
+    data = escape.json_decode(body)
+    return data.get('items', []) if isinstance(data, dict) else data
+
+
+# queryType -> function returning list of items from response body
+parsers = {'json': parse_json}
+
+
+def target_list(config):
+    """ id of the list new cards of `config` go to, None if board has none """
+    return ref_id(config._data.get('listId')) or List.objects(
+        boardId=ref_id(config._data['boardId'])).order_by('order').scalar(
+        'id').first()
+
+
+def upsert_cards(config, items, list_id, now):
+    """ create or update cards of `items` in list `list_id`, return
+    {source id: card id} and the set of ids of created cards
+    """
+    by_source = dict((str(item['id']), item) for item in items)
+    card_ids = dict(
+        (relation['sourceId'], relation['cardId'])
+        for relation in CardSourceRelation.objects(
+            syncConfigId=config.id, sourceId__in=list(by_source)
+        ).only('sourceId', 'cardId').as_pymongo())
+
+    updates = [UpdateOne({'_id': card_ids[source_id]}, {'$set': {
+        'title': item.get('title') or item.get('summary') or source_id,
+        'description': item.get('description') or '',
+        'updated': now}}) for source_id, item in by_source.items()
+        if source_id in card_ids]
+    if updates:
+        Card._get_collection().bulk_write(updates, ordered=False)
+        CardSourceRelation.objects(
+            syncConfigId=config.id, sourceId__in=list(card_ids)
+        ).update(set__lastSyncTime=now)
+
+    new_cards, relations = [], []
+    for source_id, item in by_source.items():
+        if source_id in card_ids:
+            continue
+        card = Card(
+            id=ObjectId(),
+            title=item.get('title') or item.get('summary') or source_id,
+            description=item.get('description') or '',
+            creatorId=ref_id(config._data['creatorId']), listId=list_id,
+            boardId=ref_id(config._data['boardId']))
+        card_ids[source_id] = card.id
+        new_cards.append(card)
+        relations.append(CardSourceRelation(
+            syncConfigId=config.id, cardId=card.id, sourceId=source_id,
+            sourceType=config.queryType, lastSyncTime=now))
+    Card.objects.bulk_insert(new_cards)
+    CardSourceRelation.objects.bulk_insert(relations)
+    return card_ids, set(card.id for card in new_cards)
+
+
+def upsert_comments(config, items, card_ids, now):
+    comments = dict(((card_ids[str(item['id'])], str(comment['id'])), comment)
+                    for item in items
+                    for comment in item.get('comments') or ())
+    if not comments:
+        return
+
+    existing = dict(
+        ((relation['cardId'], relation['sourceId']), relation['commentId'])
+        for relation in CommentSourceRelation.objects(
+            cardId__in=list(set(card_id for card_id, _ in comments)),
+            sourceId__in=list(set(source_id for _, source_id in comments))
+        ).only('cardId', 'sourceId', 'commentId').as_pymongo())
+
+    updates = [UpdateOne({'_id': existing[key]}, {'$set': {
+        'content': comment.get('text') or comment.get('content') or '',
+        'updatedOn': now}}) for key, comment in comments.items()
+        if key in existing]
+    if updates:
+        Comment._get_collection().bulk_write(updates, ordered=False)
+
+    new_comments, relations = [], []
+    for (card_id, source_id), comment in comments.items():
+        if (card_id, source_id) in existing:
+            continue
+        new_comment = Comment(
+            id=ObjectId(), cardId=card_id,
+            content=comment.get('text') or comment.get('content') or '',
+            authorId=ref_id(config._data['creatorId']))
+        new_comments.append(new_comment)
+        relations.append(CommentSourceRelation(
+            commentId=new_comment.id, cardId=card_id, sourceId=source_id,
+            sourceType=config.queryType, lastSyncTime=now))
+    Comment.objects.bulk_insert(new_comments)
+    CommentSourceRelation.objects.bulk_insert(relations)
+
+
+class SyncScheduler(object):
+    """ run active `SyncConfig`s periodically on the IOLoop """
+
+    def __init__(self, concurrency=4, jitter=0.1, reload_interval=60,
+                 http_client=None, request_timeout=60):
+        self.concurrency = concurrency
+        self.jitter = jitter
+        self.reload_interval = reload_interval
+        self.request_timeout = request_timeout
+        self.http_client = http_client or AsyncHTTPClient(
+            force_instance=True, max_clients=concurrency)
+        self.io_loop = ioloop.IOLoop.current()
+        # config id -> (interval in minutes, timeout handle), handle is None
+        # while the config is queued or running
+        self.scheduled = {}
+        self.queue = deque()
+        self.running = set()
+
+    def start(self):
+        self.reload()
+        ioloop.PeriodicCallback(self.reload,
+                                self.reload_interval * 1000).start()
+
+    def reload(self):
+        """ schedule new or changed active configs, drop inactive ones """
+        active = dict((config['_id'], config.get('intervalTime') or 8)
+                      for config in SyncConfig.objects(isActive=True).only(
+                          'intervalTime').as_pymongo())
+        for config_id in list(self.scheduled):
+            interval, handle = self.scheduled[config_id]
+            if active.get(config_id) != interval:
+                if handle is not None:
+                    self.io_loop.remove_timeout(handle)
+                del self.scheduled[config_id]
+        for config_id, interval in active.items():
+            if config_id not in self.scheduled:
+                # spread first runs over the interval
+                self.schedule(config_id, interval, random.random())
+
+    def schedule(self, config_id, interval, fraction=1.0):
+        delay = interval * 60 * fraction * random.uniform(
+            1 - self.jitter, 1 + self.jitter)
+        self.scheduled[config_id] = (interval, self.io_loop.add_timeout(
+            time.time() + delay, lambda: self.enqueue(config_id)))
+
+    def enqueue(self, config_id):
+        if config_id in self.scheduled:
+            self.scheduled[config_id] = (self.scheduled[config_id][0], None)
+        if config_id not in self.running and config_id not in self.queue:
+            self.queue.append(config_id)
+        self._run_queued()
+
+    def _run_queued(self):
+        while self.queue and len(self.running) < self.concurrency:
+            config_id = self.queue.popleft()
+            self.running.add(config_id)
+            self.io_loop.add_future(self.sync(config_id),
+                                    lambda f, c=config_id: self._done(c, f))
+
+    def _done(self, config_id, future):
+        self.running.discard(config_id)
+        if future.exception() is not None:
+            logger.error('sync of config %s failed: %s', config_id,
+                         future.exception())
+        if config_id in self.scheduled and \
+                self.scheduled[config_id][1] is None:
+            self.schedule(config_id, self.scheduled[config_id][0])
+        self._run_queued()
+
+    @gen.coroutine
+    def sync(self, config_id):
+        config = SyncConfig.objects(id=config_id, isActive=True).first()
+        if config is None or not config.queryUrl:
+            return
+        parser = parsers.get(config.queryType)
+        if parser is None:
+            logger.warning('no parser for queryType %r of sync config %s, '
+                           'skipped', config.queryType, config_id)
+            return
+
+        list_id = target_list(config)
+        if list_id is None:
+            logger.warning('board of sync config %s has no list, skipped',
+                           config_id)
+            return
+
+        now = datetime.now()
+        url = config.queryUrl
+        if config.lastSyncTime:
+            url = url_concat(url, {'since': config.lastSyncTime.isoformat()})
+        response = yield self.http_client.fetch(
+            url, request_timeout=self.request_timeout)
+
+        try:
+            items = parser(response.body)
+        except ValueError as e:
+            logger.warning('response of sync config %s not parsed: %s',
+                           config_id, e)
+            return
+        if items:
+            card_ids, created = upsert_cards(config, items, list_id, now)
+            upsert_comments(config, items, card_ids, now)
+            for card in Card.objects(id__in=list(card_ids.values())):
+                SockCRUDMixin._run_hooks(
+                    'create' if card.id in created else 'update', card)
+        SyncConfig.objects(id=config.id).update_one(set__lastSyncTime=now)
+        logger.info('synced %d items of config %s', len(items), config_id)
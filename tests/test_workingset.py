@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of `models.workingset.HotBoards` without a database, records are
+built by a stub instead of `_build`.
+
+    Example usage::
+
+        python -m unittest discover tests
+"""
+import os
+import sys
+import unittest
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from models.workingset import BoardRecords, HotBoards
+
+
+class StubHotBoards(HotBoards):
+    """ builds records of a board with one list and one card, numbering
+    builds in the board title
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(StubHotBoards, self).__init__(*args, **kwargs)
+        self.builds = 0
+        self.deleted = set()
+
+    def _build(self, board_id):
+        if board_id in self.deleted:
+            return None
+        self.builds += 1
+        list_id, card_id = board_id + '-list', board_id + '-card'
+        return BoardRecords(
+            {'_id': board_id, 'title': 'build %d' % self.builds},
+            OrderedDict([(list_id, {'_id': list_id, 'boardId': board_id})]),
+            OrderedDict([(card_id, {'_id': card_id, 'boardId': board_id,
+                                    'listId': list_id})]))
+
+
+class HotBoardsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.hot = StubHotBoards(budget=2 ** 20, max_age=60)
+        self.hot.load('b1')
+
+    def expire(self, board_id):
+        self.hot.boards[board_id].loaded -= self.hot.max_age + 1
+
+    def test_read_within_max_age_is_served_from_records(self):
+        self.assertEqual(len(self.hot.lists('b1')), 1)
+        self.assertEqual(self.hot.builds, 1)
+
+    def test_read_after_max_age_rebuilds_records(self):
+        self.expire('b1')
+
+        cards = self.hot.cards({'listId': 'b1-list'})
+
+        self.assertEqual(self.hot.builds, 2)
+        self.assertEqual([card['_id'] for card in cards], ['b1-card'])
+        self.assertEqual(cards[0]['board']['title'], 'build 2')
+        self.assertIn('b1', self.hot.boards)
+        self.assertEqual(self.hot.parents['b1-card'], 'b1')
+        self.assertEqual(self.hot.used, self.hot.boards['b1'].size)
+
+    def test_rebuilt_board_is_most_recently_used(self):
+        self.hot.load('b2')
+        self.expire('b1')
+
+        self.hot.lists('b1')
+
+        self.assertEqual(list(self.hot.boards), ['b2', 'b1'])
+
+    def test_read_after_max_age_of_deleted_board_evicts_it(self):
+        self.hot.deleted.add('b1')
+        self.expire('b1')
+
+        self.assertIsNone(self.hot.lists('b1'))
+        self.assertNotIn('b1', self.hot.boards)
+        self.assertNotIn('b1-card', self.hot.parents)
+        self.assertEqual(self.hot.used, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+"""
+Import of Trello board exports.
+
+The export is parsed incrementally with ijson, one pass per section, so
+memory depends on the number of cards (for the id remapping) and not on
+size of the file. Documents get their ids assigned before insert and are
+written in batches with `AwesomerQuerySet.bulk_insert`.
+
+    Example usage::
+
+        python trello.py board.json --user=<user id>
+
+The app runs the same command as a background job, see `start_job()`.
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import sys
+import time
+import uuid
+from datetime import datetime
+
+from bson import ObjectId
+
+from models import *
+from models import connect_db, connection_settings
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+SECTIONS = ('labels', 'lists', 'cards', 'checklists', 'actions')
+
+# inserted before their children, `cascade.delete_orphans` running during an
+# import must never find a child whose parent is still pending
+PARENTS = (Board, List, Card)
+
+
+def parse_date(value):
+    if not value:
+        return None
+    return datetime.strptime(value[:19], '%Y-%m-%dT%H:%M:%S')
+
+
+class BatchWriter(object):
+    """ collect new documents and bulk insert them per document class """
+
+    def __init__(self, batch_size):
+        self.batch_size = batch_size
+        self.pending = {}
+        self.counts = {}
+
+    def add(self, doc):
+        cls = type(doc)
+        docs = self.pending.setdefault(cls, [])
+        docs.append(doc)
+        if len(docs) >= self.batch_size:
+            self.flush(cls)
+
+    def flush(self, cls=None):
+        """ insert pending documents of `cls` or of every class, pending
+        documents of their parents first
+        """
+        if cls is None:
+            classes = list(PARENTS) + list(self.pending)
+        elif cls in PARENTS:
+            classes = PARENTS[:PARENTS.index(cls) + 1]
+        else:
+            classes = list(PARENTS) + [cls]
+        for cls in classes:
+            docs = self.pending.pop(cls, None)
+            if not docs:
+                continue
+            cls.objects.bulk_insert(docs)
+            self.counts[cls.__name__] = \
+                self.counts.get(cls.__name__, 0) + len(docs)
+
+
+class TrelloImporter(object):
+    """ import one Trello board export as a new board created by `user_id`
+
+    `progress` is called with a dict of counts of imported documents
+    """
+
+    def __init__(self, path, user_id, batch_size=500, progress=None):
+        if ijson is None:
+            raise RuntimeError('importing from Trello needs ijson installed')
+
+        self.path = path
+        self.user_id = ObjectId(user_id)
+        self.writer = BatchWriter(batch_size)
+        self.progress = progress or (lambda status: None)
+        # trello id -> our id
+        self.ids = {'label': {}, 'list': {}, 'card': {}}
+
+    def items(self, section):
+        with open(self.path, 'rb') as export:
+            for item in ijson.items(export, section + '.item'):
+                yield item
+
+    def run(self):
+        board = self.import_board()
+        for section in SECTIONS:
+            for i, item in enumerate(self.items(section)):
+                getattr(self, 'import_' + section.rstrip('s'))(board, i, item)
+                if i % self.writer.batch_size == 0:
+                    self.report(section, board)
+            self.writer.flush()
+            self.report(section, board)
+        self.report('done', board)
+        return board
+
+    def report(self, stage, board):
+        self.progress({'stage': stage, 'boardId': str(board.id),
+                       'counts': dict(self.writer.counts)})
+
+    def import_board(self):
+        fields = {}
+        with open(self.path, 'rb') as export:
+            for prefix, event, value in ijson.parse(export):
+                if prefix in ('name', 'desc', 'closed',
+                              'prefs.permissionLevel'):
+                    fields[prefix] = value
+                elif event == 'start_array' and prefix in SECTIONS:
+                    break
+
+        board = Board(title=fields.get('name') or 'Imported from Trello',
+                      description=fields.get('desc') or '',
+                      isClosed=bool(fields.get('closed')),
+                      isPublic=fields.get('prefs.permissionLevel') == 'public',
+                      creatorId=self.user_id).save()
+        BoardMemberRelation(boardId=board.id, userId=self.user_id).save()
+        Activity(content='This board is imported from Trello',
+                 creatorId=self.user_id, boardId=board.id).save()
+        return board
+
+    def import_label(self, board, i, item):
+        label = Label(id=ObjectId(), title=item.get('name') or '',
+                      order=i, color=item.get('color') or 'grey',
+                      boardId=board.id)
+        self.ids['label'][item['id']] = label.id
+        self.writer.add(label)
+
+    def import_list(self, board, i, item):
+        list_ = List(id=ObjectId(), title=item.get('name') or 'Untitled',
+                     isArchived=bool(item.get('closed')),
+                     order=int(item.get('pos') or i), creatorId=self.user_id,
+                     boardId=board.id)
+        self.ids['list'][item['id']] = list_.id
+        self.writer.add(list_)
+
+    def import_card(self, board, i, item):
+        list_id = self.ids['list'].get(item.get('idList'))
+        if list_id is None:
+            return
+
+        card = Card(id=ObjectId(), title=item.get('name') or 'Untitled',
+                    description=item.get('desc') or '',
+                    isArchived=bool(item.get('closed')),
+                    dueDate=parse_date(item.get('due')),
+                    order=int(item.get('pos') or i), creatorId=self.user_id,
+                    listId=list_id, boardId=board.id)
+        self.ids['card'][item['id']] = card.id
+        self.writer.add(card)
+
+        for label_id in item.get('idLabels') or ():
+            if label_id in self.ids['label']:
+                self.writer.add(CardLabelRelation(
+                    boardId=board.id, cardId=card.id, selected=True,
+                    labelId=self.ids['label'][label_id]))
+
+        for attachment in item.get('attachments') or ():
+            self.writer.add(Attachment(
+                cardId=card.id, uploaderId=self.user_id,
+                name=attachment.get('name') or attachment.get('url'),
+                size=float(attachment.get('bytes') or 0),
+                fileType='picture' if attachment.get('previews') else 'other',
+                path=attachment.get('url') or '',
+                createdOn=parse_date(attachment.get('date')) or
+                datetime.now()))
+
+    def import_checklist(self, board, i, item):
+        card_id = self.ids['card'].get(item.get('idCard'))
+        if card_id is None:
+            return
+
+        checklist = Checklist(id=ObjectId(),
+                              title=item.get('name') or 'Checklist',
+                              cardId=card_id, authorId=self.user_id)
+        self.writer.add(checklist)
+        for j, check_item in enumerate(item.get('checkItems') or ()):
+            self.writer.add(ChecklistItem(
+                content=check_item.get('name') or '',
+                checked=check_item.get('state') == 'complete',
+                order=int(check_item.get('pos') or j),
+                checklistId=checklist.id, cardId=card_id,
+                authorId=self.user_id))
+
+    def import_action(self, board, i, item):
+        if item.get('type') != 'commentCard':
+            return
+
+        data = item.get('data') or {}
+        card_id = self.ids['card'].get((data.get('card') or {}).get('id'))
+        if card_id is None:
+            return
+
+        created = parse_date(item.get('date')) or datetime.now()
+        self.writer.add(Comment(content=data.get('text') or '',
+                                cardId=card_id, authorId=self.user_id,
+                                createdOn=created, updatedOn=created))
+
+
+# job id -> last progress reported by the importing process
+jobs = {}
+# seconds the progress of a finished job is kept for polling clients
+job_ttl = 3600
+
+
+def start_job(path, user_id):
+    """ import `path` in a child process, return id of the job in `jobs` """
+    from tornado.ioloop import IOLoop
+    from tornado.process import Subprocess
+
+    job_id = uuid.uuid4().hex
+    jobs[job_id] = {'stage': 'starting'}
+    # in the environment, command lines are visible to every user in `ps`
+    process = Subprocess(
+        [sys.executable, os.path.abspath(__file__), path,
+         '--user=%s' % user_id, '--remove'],
+        env=dict(os.environ, CANTAS_MONGO=json.dumps(connection_settings())),
+        stdout=Subprocess.STREAM)
+
+    def on_line(line):
+        jobs[job_id] = json.loads(line.decode('utf-8'))
+        process.stdout.read_until(b'\n', on_line)
+
+    def on_exit(status):
+        if status:
+            jobs[job_id] = dict(jobs[job_id], stage='failed')
+        IOLoop.current().add_timeout(time.time() + job_ttl,
+                                     lambda: jobs.pop(job_id, None))
+
+    process.stdout.read_until(b'\n', on_line)
+    process.set_exit_callback(on_exit)
+    return job_id
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('path', help='Trello board export (json)')
+    parser.add_argument('--user', required=True, help='id of importing user')
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--mongo',
+                        default=os.environ.get('CANTAS_MONGO', '{}'),
+                        help='json of models.connect_db() settings, '
+                             'default $CANTAS_MONGO')
+    parser.add_argument('--remove', action='store_true',
+                        help='remove the export file when done')
+    args = parser.parse_args()
+
+    connect_db(**json.loads(args.mongo))
+
+    def progress(status):
+        print(json.dumps(status))
+        sys.stdout.flush()
+
+    try:
+        TrelloImporter(args.path, args.user, args.batch_size, progress).run()
+    finally:
+        if args.remove:
+            os.remove(args.path)
+
+
+if __name__ == '__main__':
+    main()
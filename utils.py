@@ -13,3 +13,55 @@ class ComplexEncoder(json.JSONEncoder):
         if isinstance(obj, ObjectId):
             return str(obj)
         return json.JSONEncoder.default(self, obj)
+
+
+class StreamedUpload(object):
+    """ write the file of a request body received in chunks to `output`
+
+    The body is either the file itself or multipart/form-data with the file
+    as its first part, the rest of the form is ignored.
+    """
+    max_headers = 65536
+
+    def __init__(self, output, content_type):
+        self.output = output
+        self.boundary = None
+        for param in content_type.split(';')[1:]:
+            key, _, value = param.strip().partition('=')
+            if key == 'boundary' and \
+                    content_type.startswith('multipart/form-data'):
+                self.boundary = b'\r\n--' + value.strip('"').encode()
+        # the file ends with the body unless it is a part of a form
+        self.complete = self.boundary is None
+        self.in_file = False
+        self.buffer = b''
+
+    def write(self, chunk):
+        if self.boundary is None:
+            self.output.write(chunk)
+            return
+        if self.complete:
+            return
+
+        self.buffer += chunk
+        if not self.in_file:
+            # skip the opening boundary and headers of the part
+            start = self.buffer.find(b'\r\n\r\n')
+            if start == -1:
+                if len(self.buffer) > self.max_headers:
+                    raise ValueError('no file in multipart body')
+                return
+            self.buffer = self.buffer[start + 4:]
+            self.in_file = True
+
+        end = self.buffer.find(self.boundary)
+        if end != -1:
+            self.output.write(self.buffer[:end])
+            self.buffer = b''
+            self.complete = True
+            return
+        # the boundary may be split between this chunk and the next one
+        keep = len(self.boundary) - 1
+        if len(self.buffer) > keep:
+            self.output.write(self.buffer[:-keep])
+            self.buffer = self.buffer[-keep:]